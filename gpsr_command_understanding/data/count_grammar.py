@@ -0,0 +1,45 @@
+import argparse
+import itertools
+
+from gpsr_command_understanding.generator.counting import DerivationCounter
+from gpsr_command_understanding.generator.generator import Generator
+from gpsr_command_understanding.generator.loading_helpers import load, load_2018, GRAMMAR_YEAR_TO_MODULE
+from gpsr_command_understanding.generator.tokens import ROOT_SYMBOL
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Report how many sentences a grammar produces, without generating them")
+    parser.add_argument("year", type=int)
+    parser.add_argument("task")
+    parser.add_argument("--branch-caps", default=[1, 2, 3], nargs='+', type=int)
+    parser.add_argument("--groundings", default=0, type=int,
+                        help="also count the groundings of this many enumerated sentences")
+    args = parser.parse_args()
+
+    if args.year == 2018:
+        generator = load_2018(GRAMMAR_YEAR_TO_MODULE[2018])
+    else:
+        generator = Generator(None, grammar_format_version=args.year)
+        load(generator, args.task, GRAMMAR_YEAR_TO_MODULE[args.year])
+
+    counter = DerivationCounter(generator.compiled)
+    for symbol in generator.rules.keys():
+        print("{:>40}: {}".format(symbol.to_human_readable(), counter.count(symbol)))
+    for cycle in counter.cycles:
+        print("Cycle: " + " -> ".join(symbol.to_human_readable() for symbol in cycle))
+
+    print("Sentences: {}".format(generator.count_derivations(ROOT_SYMBOL)))
+    for branch_cap in args.branch_caps:
+        count = generator.count_derivations(ROOT_SYMBOL, branch_cap=branch_cap)
+        print("Sentences with branch cap {}: {}".format(branch_cap, count))
+
+    if args.groundings:
+        sentences = [generator.extract_metadata(sentence)[0]
+                     for sentence in itertools.islice(generator.enumerate(ROOT_SYMBOL), args.groundings)]
+        counts = generator.count_groundings(sentences)
+        print("Groundings over {} sentences: {} total, min {} mean {:.1f} max {}".format(
+            len(counts), sum(counts), min(counts), sum(counts) / len(counts), max(counts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
+import argparse
 import os
-import sys
 from random import Random
 
 import numpy as np
@@ -10,6 +10,8 @@ from gpsr_command_understanding.generator.grammar import tree_printer
 from gpsr_command_understanding.generator.loading_helpers import load, GRAMMAR_YEAR_TO_MODULE
 from gpsr_command_understanding.generator.tokens import ROOT_SYMBOL
 from gpsr_command_understanding.generator.paired_generator import pairs_without_placeholders, PairedGenerator
+from gpsr_command_understanding.generator.parallel import enumerate_parallel
+from gpsr_command_understanding.generator.streaming import stream_enumeration
 
 
 def get_annotated_sentences(sentences_and_pairs):
@@ -27,15 +29,45 @@ def get_annotated_sentences(sentences_and_pairs):
 
 
 def main():
-    year = int(sys.argv[1])
-    task = sys.argv[2]
+    parser = argparse.ArgumentParser()
+    parser.add_argument("year", type=int)
+    parser.add_argument("task")
+    parser.add_argument("--stream", action="store_true",
+                        help="write sentences to disk as they're enumerated, deduplicating on disk. Resumes an interrupted run")
+    parser.add_argument("--state", default=None, help="checkpoint and deduplication file for --stream")
+    parser.add_argument("--checkpoint-every", default=100000, type=int)
+    parser.add_argument("--fresh", action="store_true", help="discard any checkpoint and start over")
+    parser.add_argument("--processes", default=None, type=int,
+                        help="enumerate with this many processes. The output is the same as a serial run")
+    parser.add_argument("--split-depth", default=2, type=int,
+                        help="how many expansions deep to partition the grammar between processes")
+    args = parser.parse_args()
+    year = args.year
+    task = args.task
     out_root = os.path.abspath(os.path.dirname(__file__) + "/../../data/")
 
     generator = PairedGenerator(None, grammar_format_version=year)
     load(generator, task, GRAMMAR_YEAR_TO_MODULE[year])
 
-    sentences = [pair[0] for pair in
-                 generator.generate(ROOT_SYMBOL, yield_requires_semantics=False)]
+    if args.stream and args.processes:
+        print("--stream checkpoints a single enumeration and can't be combined with --processes")
+        exit(1)
+
+    if args.stream:
+        out_path = join(out_root, "{}_{}_sentences.txt".format(year, task))
+        state_path = args.state if args.state else out_path + ".state"
+        if args.fresh and os.path.exists(state_path):
+            os.remove(state_path)
+        written, _ = stream_enumeration(generator, ROOT_SYMBOL, out_path, state_path,
+                                        checkpoint_every=args.checkpoint_every)
+        print("{} unique sentences written to {}".format(written, out_path))
+        return
+
+    if args.processes:
+        sentences = list(enumerate_parallel(generator, ROOT_SYMBOL, split_depth=args.split_depth,
+                                            processes=args.processes, unique=True))
+    else:
+        sentences = list(generator.enumerate(ROOT_SYMBOL))
     [generator.extract_metadata(sentence) for sentence in sentences]
     sentences = set(sentences)
 
@@ -45,7 +77,7 @@ def main():
             f.write(tree_printer(sentence) + '\n')
 
     baked_sentences = [tree_printer(x) for x in sentences]
-    all_pairs = pairs_without_placeholders(generator)
+    all_pairs = pairs_without_placeholders(generator, processes=args.processes)
     baked_pairs = {tree_printer(key): tree_printer(value) for key, value in all_pairs.items()}
 
     annotated, unannotated, out_of_grammar = get_annotated_sentences((sentences, all_pairs))
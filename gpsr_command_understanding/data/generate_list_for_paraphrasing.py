@@ -26,9 +26,7 @@ def main():
     all_examples = []
     grounded_examples = []
     for ungrounded in all:
-        grounder = generator.generate_grounding_assignments(ungrounded, random_generator=random_source)
-        for i in range(groundings_per_parse):
-            assignment = next(grounder)
+        for assignment in generator.sample_grounding_assignments(ungrounded, random_source, count=groundings_per_parse):
             grounded = generator.apply_grounding_assignment(ungrounded, assignment)
             # Remove unhelpful wildcards like pronouns
             for key in list(assignment.keys()):
@@ -91,6 +91,8 @@ def main():
     parser.add_argument("--seed", default=0, required=False, type=int)
     parser.add_argument("-i", "--incremental-datasets", action='store_true', required=False)
     parser.add_argument("-f", "--force-overwrite", action="store_true", required=False, default=False)
+    parser.add_argument("--processes", default=None, required=False, type=int,
+                        help="expand the semantics with this many processes")
     args = parser.parse_args()
 
     validate_args(args)
@@ -129,7 +131,7 @@ def main():
         pairs = merge_dicts(pairs, paraphrasing_pairs)
 
     if args.anonymized or args.groundings:
-        gen_pairs = pairs_without_placeholders(generator)
+        gen_pairs = pairs_without_placeholders(generator, processes=args.processes)
     if args.anonymized:
         old_kb = generator.knowledge_base
         generator.knowledge_base = AnonymizedKnowledgebase()
@@ -159,9 +161,12 @@ def main():
 
     if args.groundings:
         grounded_pairs = {}
-        for utt, logical in gen_pairs.items():
-            groundings = generator.generate_groundings((utt, logical), random_source)
-            groundings = itertools.islice(groundings, args.groundings)
+        # Templates with fewer groundings than asked for just get all of theirs
+        budgets = [min(count, args.groundings) for count in generator.count_groundings(gen_pairs.keys())]
+        print("Grounding {} templates: {} groundings ({} templates have fewer than {})".format(
+            len(budgets), sum(budgets), sum(1 for budget in budgets if budget < args.groundings), args.groundings))
+        for (utt, logical), budget in zip(gen_pairs.items(), budgets):
+            groundings = generator.generate_grounded_text((utt, logical), random_source, count=budget)
             for grounded_utt, grounded_logical in groundings:
                 grounded_pairs[grounded_utt] = grounded_logical
 
@@ -7,13 +7,17 @@ from gpsr_command_understanding.generator.loading_helpers import load_paired, GR
 from gpsr_command_understanding.parser import GrammarBasedParser, AnonymizingParser
 
 
-def main():
+def build_parser():
     generator = Generator(None)
     load_paired(generator, "gpsr", GRAMMAR_DIR_2019)
 
     parser = GrammarBasedParser(generator.rules)
     anonymizer = NumberingAnonymizer.from_knowledge_base(generator.knowledge_base)
-    parser = AnonymizingParser(parser, anonymizer)
+    return AnonymizingParser(parser, anonymizer)
+
+
+def main():
+    parser = build_parser()
     while True:
         print("Type in a command")
         utterance = input()
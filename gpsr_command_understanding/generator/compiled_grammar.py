@@ -0,0 +1,231 @@
+import itertools
+
+from lark import Tree
+
+from gpsr_command_understanding.generator.derivation import IndexedSentence, is_void
+from gpsr_command_understanding.generator.tokens import ComplexWildCard
+
+
+class ChoiceSymbol(object):
+    """
+    Stands in for an inline ( a | b ) choice that was left in a production. Each one is its own
+    anonymous nonterminal whose productions are the options.
+    """
+    __slots__ = ("number",)
+
+    def __init__(self, number):
+        self.number = number
+
+    def to_human_readable(self):
+        return "$choice{}".format(self.number)
+
+    def __str__(self):
+        return "Choice({})".format(self.number)
+
+
+class CompiledGrammar(object):
+    """
+    A rules dictionary with every token interned to an integer ID.
+
+    Productions become IndexedSentences over IDs, so the hot loops compare and look up small integers
+    instead of hashing token objects. Symbols that have productions are open; everything else (words,
+    wildcards) is a terminal as far as expansion is concerned.
+    :param rules: dictionary from symbol to list of production trees
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.symbols = []
+        self.ids = {}
+        self.is_open = []
+        # Each symbol's ID, except that wildcards with the same metadata share one. Sequences map to equal tuples
+        # exactly when their trees would find each other as dictionary keys
+        self.canonical = []
+        self._canonical_meta = {}
+        # The same information as is_open, for callers that test membership
+        self.open_ids = set()
+        # Indexed by symbol ID. None for terminals
+        self.productions = []
+        # Same as productions, but with void wildcards dropped. Built on first use
+        self._productions_without_void = None
+        # Productions with their inline choices made, per symbol ID. Built as symbols are asked for
+        self._resolved = {}
+        self._resolved_without_void = {}
+        # canonical_key of each of the productions in _resolved_without_void
+        self._canonical_resolved = {}
+
+        for symbol in rules.keys():
+            self.intern(symbol)
+            self.is_open[self.ids[symbol]] = True
+            self.open_ids.add(self.ids[symbol])
+        for symbol, symbol_productions in rules.items():
+            self.productions[self.ids[symbol]] = [self._compile_sequence(production)
+                                                  for production in symbol_productions]
+
+    @staticmethod
+    def _key(token):
+        # Wildcards carrying metadata are interned by identity so generation hands back the exact
+        # annotations that were written at each point in the grammar
+        if isinstance(token, ComplexWildCard) and token.metadata:
+            return "meta", id(token)
+        return token
+
+    def intern(self, token):
+        key = token if token in self.rules else self._key(token)
+        token_id = self.ids.get(key)
+        if token_id is None:
+            token_id = len(self.symbols)
+            self.ids[key] = token_id
+            self.symbols.append(token)
+            self.is_open.append(False)
+            self.productions.append(None)
+            # Wildcards hash their metadata (though they don't compare it), so it has to match too
+            self.canonical.append(self._canonical_meta.setdefault(token.to_human_readable(), token_id)
+                                  if key is not token else token_id)
+        return token_id
+
+    def _compile_sequence(self, tree):
+        """
+        :param tree: an expression tree, or a bare token
+        :return: IndexedSentence of the flattened sequence
+        """
+        ids = self._compile_ids(tree, [])
+        return IndexedSentence(tuple(ids), tuple(i for i, token_id in enumerate(ids) if self.is_open[token_id]))
+
+    def _compile_ids(self, tree, ids):
+        if not isinstance(tree, Tree):
+            ids.append(self.intern(tree))
+            return ids
+        for child in tree.children:
+            if not isinstance(child, Tree):
+                ids.append(self.intern(child))
+            elif child.data in ("expression", "top_expression"):
+                self._compile_ids(child, ids)
+            elif child.data == "choice":
+                ids.append(self._compile_choice(child))
+            else:
+                raise ValueError("Can't compile {} subtree into a production".format(child.data))
+        return ids
+
+    def _compile_choice(self, choice):
+        symbol = ChoiceSymbol(len(self.symbols))
+        token_id = len(self.symbols)
+        self.ids[symbol] = token_id
+        self.symbols.append(symbol)
+        self.is_open.append(True)
+        self.open_ids.add(token_id)
+        self.productions.append(None)
+        self.canonical.append(token_id)
+        self.productions[token_id] = [self._compile_sequence(option) for option in choice.children]
+        return token_id
+
+    def productions_without_void(self):
+        if self._productions_without_void is None:
+            stripped = []
+            for symbol_productions in self.productions:
+                if symbol_productions is None:
+                    stripped.append(None)
+                    continue
+                stripped.append([self._without_void(production) for production in symbol_productions])
+            self._productions_without_void = stripped
+        return self._productions_without_void
+
+    def _without_void(self, production):
+        ids = tuple(token_id for token_id in production.tokens if not is_void(self.symbols[token_id]))
+        return IndexedSentence(ids, tuple(i for i, token_id in enumerate(ids) if self.is_open[token_id]))
+
+    def resolved_productions(self, token_id, discard_void=False):
+        """
+        Rules loaded without expand_shorthand keep their choices as ChoiceSymbols. This gives the productions of a
+        symbol as though they had been expanded: every way of making the inline choices, in the order expand_shorthand
+        would produce them. Productions without choices are passed through as they are.
+        :param token_id: ID of a symbol with productions
+        :param discard_void: drop void wildcards from the results
+        :return: list of (index of the production in productions[token_id], IndexedSentence) tuples
+        """
+        cache = self._resolved_without_void if discard_void else self._resolved
+        resolved = cache.get(token_id)
+        if resolved is not None:
+            return resolved
+        resolved = []
+        for index, production in enumerate(self.productions[token_id]):
+            alternatives = self._choice_alternatives(production.tokens)
+            if len(alternatives) == 1 and alternatives[0] == production.tokens:
+                resolved.append((index, self.productions_without_void()[token_id][index] if discard_void else production))
+                continue
+            for ids in alternatives:
+                if discard_void:
+                    ids = tuple(i for i in ids if not is_void(self.symbols[i]))
+                resolved.append((index, IndexedSentence(ids, tuple(i for i, token_id in enumerate(ids)
+                                                                   if self.is_open[token_id]))))
+        cache[token_id] = resolved
+        return resolved
+
+    def _choice_alternatives(self, ids):
+        # Same order as expand_shorthand: the first choice varies slowest and options are taken last to first
+        options_per_token = []
+        for token_id in ids:
+            if isinstance(self.symbols[token_id], ChoiceSymbol):
+                options = []
+                for option in reversed(self.productions[token_id]):
+                    options.extend(self._choice_alternatives(option.tokens))
+                options_per_token.append(options)
+            else:
+                options_per_token.append([(token_id,)])
+        return [sum(combination, ()) for combination in itertools.product(*options_per_token)]
+
+    def compile_tokens(self, tokens, discard_void=False):
+        """
+        Intern a sequence of tokens that may not come from the grammar (e.g. a start tree)
+        :return: IndexedSentence
+        """
+        if discard_void:
+            tokens = [token for token in tokens if not is_void(token)]
+        ids = tuple(self.intern(token) for token in tokens)
+        return IndexedSentence(ids, tuple(i for i, token_id in enumerate(ids) if self.is_open[token_id]))
+
+    def derive(self, stack, branch_cap=None):
+        """
+        Expand derivations leftmost-first, depth first.
+        :param stack: list of Derivations over this grammar's IDs, last one first. Updated in place
+        :param branch_cap: limit on the number of different branches to pursue
+        :return: generator of completed sentences as lists of IDs
+        """
+        productions = self.productions
+        open_ids = self.open_ids
+        while len(stack) != 0:
+            derivation = stack.pop()
+            replace_id = derivation.next_symbol
+            if replace_id is None:
+                yield derivation.tokens()
+                continue
+            options = productions[replace_id]
+            if branch_cap:
+                options = options[:min(branch_cap, len(options))]
+            for production in options:
+                stack.append(derivation.expand(production.tokens, open_ids))
+
+    def canonical_key(self, ids):
+        """
+        :param ids: sequence of symbol IDs
+        :return: tuple that's equal for any two sequences whose trees would find each other as dictionary keys
+        """
+        return tuple(map(self.canonical.__getitem__, ids))
+
+    def canonical_productions(self, token_id):
+        """
+        :return: list with the canonical_key of each production in resolved_productions(token_id, discard_void=True)
+        """
+        keys = self._canonical_resolved.get(token_id)
+        if keys is None:
+            keys = [self.canonical_key(production.tokens)
+                    for _, production in self.resolved_productions(token_id, discard_void=True)]
+            self._canonical_resolved[token_id] = keys
+        return keys
+
+    def to_tokens(self, ids):
+        symbols = self.symbols
+        return [symbols[token_id] for token_id in ids]
+
+    def to_tree(self, sentence):
+        return Tree("expression", self.to_tokens(sentence.tokens))
@@ -0,0 +1,139 @@
+import bisect
+import math
+
+
+class DerivationCounter(object):
+    """
+    Counts the sentences each symbol of a compiled grammar derives, without enumerating them.
+
+    Counts are memoized per symbol ID, so a whole grammar costs one visit per production. They match the number of
+    sentences enumerate yields (duplicates included). A symbol that can derive itself has infinitely many derivations;
+    its count is math.inf and the loop is recorded in cycles.
+    :param compiled: CompiledGrammar
+    :param branch_cap: count as if only the first branch_cap productions of each symbol were used, like enumerate does
+    """
+
+    def __init__(self, compiled, branch_cap=None):
+        self.compiled = compiled
+        self.branch_cap = branch_cap
+        # Each cycle is a list of symbols, starting and ending with the same one
+        self.cycles = []
+        self._counts = {}
+        # Symbols currently being counted, in the order they were entered
+        self._path = []
+        self._on_path = {}
+
+    def count(self, symbol):
+        """
+        :param symbol: a token from the grammar
+        :return: the number of sentences it derives. 1 for terminals
+        """
+        return self.count_id(self.compiled.intern(symbol))
+
+    def count_sequence(self, ids):
+        """
+        :param ids: iterable of symbol IDs
+        :return: the number of sentences the sequence derives
+        """
+        total = 1
+        for token_id in ids:
+            count = self.count_id(token_id)
+            if count == 0:
+                # Nothing complete can come out of this sequence, no matter what else is in it
+                return 0
+            total *= count
+        return total
+
+    def count_id(self, token_id):
+        if not self.compiled.is_open[token_id]:
+            return 1
+        count = self._counts.get(token_id)
+        if count is not None:
+            return count
+        if token_id in self._on_path:
+            symbols = self.compiled.symbols
+            self.cycles.append([symbols[i] for i in self._path[self._on_path[token_id]:]] + [symbols[token_id]])
+            return math.inf
+
+        productions = self.compiled.productions[token_id]
+        if self.branch_cap:
+            productions = productions[:min(self.branch_cap, len(productions))]
+        self._on_path[token_id] = len(self._path)
+        self._path.append(token_id)
+        count = 0
+        for production in productions:
+            count += self.count_sequence(production.tokens)
+        self._path.pop()
+        del self._on_path[token_id]
+        self._counts[token_id] = count
+        return count
+
+
+class DerivationSampler(object):
+    """
+    Draws sentences uniformly from everything enumerate would produce, with no backtracking. Each production
+    is picked with probability proportional to the number of sentences it derives, so one sample costs
+    O(sentence length) after the counts are known.
+    :param counter: DerivationCounter for the grammar to sample from
+    :param weights: optional dictionary from symbol to a list with a weight for each production in rules[symbol]. A production's
+        probability is proportional to its weight times its count; symbols that aren't listed weigh every production 1.
+        Inline choices are anonymous, so they can't be weighted
+    """
+
+    def __init__(self, counter, weights=None):
+        self.counter = counter
+        compiled = counter.compiled
+        self.weights = {compiled.intern(symbol): symbol_weights for symbol, symbol_weights in (weights or {}).items()}
+        # Running totals of the production counts of each open symbol, for bisecting into. Filled as symbols are reached
+        self._cumulative = {}
+
+    def _totals(self, token_id):
+        totals = self._cumulative.get(token_id)
+        if totals is not None:
+            return totals
+        counter = self.counter
+        productions = counter.compiled.productions[token_id]
+        if counter.branch_cap:
+            productions = productions[:min(counter.branch_cap, len(productions))]
+        weights = self.weights.get(token_id)
+        totals = []
+        total = 0
+        for i, production in enumerate(productions):
+            count = counter.count_sequence(production.tokens)
+            if count == math.inf:
+                raise ValueError("Can't sample uniformly from a cyclic grammar: " + " -> ".join(
+                    symbol.to_human_readable() for symbol in counter.cycles[0]))
+            if weights is not None:
+                count *= weights[i]
+            total += count
+            totals.append(total)
+        if total == 0:
+            symbol = counter.compiled.symbols[token_id]
+            raise ValueError("{} can't derive any sentences".format(symbol.to_human_readable()))
+        self._cumulative[token_id] = totals
+        return totals
+
+    def sample(self, ids, random_generator):
+        """
+        :param ids: sequence of symbol IDs to expand
+        :param random_generator: source of randomness
+        :return: list of IDs of the completed sentence
+        """
+        compiled = self.counter.compiled
+        productions = compiled.productions
+        is_open = compiled.is_open
+        out = []
+        stack = list(reversed(ids))
+        while stack:
+            token_id = stack.pop()
+            if not is_open[token_id]:
+                out.append(token_id)
+                continue
+            totals = self._totals(token_id)
+            if isinstance(totals[-1], int):
+                # Exact, no matter how big the counts get
+                point = random_generator.randrange(totals[-1])
+            else:
+                point = random_generator.random() * totals[-1]
+            stack.extend(reversed(productions[token_id][bisect.bisect_right(totals, point)].tokens))
+        return out
@@ -0,0 +1,165 @@
+import weakref
+
+from lark import Tree
+
+from gpsr_command_understanding.generator.tokens import NonTerminal
+
+
+def rule_dependencies(rules):
+    """
+    :param rules: dictionary from symbol to list of production trees
+    :return: dictionary from each symbol in rules to the set of nonterminals its productions use
+    """
+    dependencies = {}
+    for symbol, productions in rules.items():
+        used = set()
+        for production in productions:
+            if isinstance(production, Tree):
+                used.update(production.scan_values(lambda token: isinstance(token, NonTerminal)))
+            elif isinstance(production, NonTerminal):
+                used.add(production)
+        dependencies[symbol] = used
+    return dependencies
+
+
+def reachable(dependencies, roots):
+    """
+    :param dependencies: as from rule_dependencies
+    :param roots: iterable of symbols
+    :return: set of the roots and every symbol they can derive through
+    """
+    seen = set(roots)
+    stack = list(seen)
+    while stack:
+        for used in dependencies.get(stack.pop(), ()):
+            if used not in seen:
+                seen.add(used)
+                stack.append(used)
+    return seen
+
+
+def dependents(dependencies, symbols):
+    """
+    :param dependencies: as from rule_dependencies
+    :param symbols: iterable of symbols
+    :return: set of the symbols and every symbol whose derivations can pass through one of them
+    """
+    used_by = {}
+    for symbol, used in dependencies.items():
+        for dependency in used:
+            used_by.setdefault(dependency, []).append(symbol)
+    return reachable(used_by, symbols)
+
+
+class DerivedArtifacts(object):
+    """
+    Values computed from a generator's rules (pair sets, parsers...), each stored with the set of symbols it was
+    computed from. When a few rules are reloaded, only the values that could have seen them are thrown away.
+    """
+
+    def __init__(self):
+        self._entries = {}
+
+    def get(self, key, depends_on, build):
+        """
+        :param key: names the value
+        :param depends_on: set of symbols (or other hashable keys, like semantics utterances) the value is computed from
+        :param build: called with no arguments to make the value if it isn't stored
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            entry = (frozenset(depends_on), build())
+            self._entries[key] = entry
+        return entry[1]
+
+    def invalidate(self, changed):
+        """
+        :param changed: set of symbols that changed
+        :return: list of the keys that were dropped
+        """
+        dropped = [key for key, (depends_on, _) in self._entries.items() if not depends_on.isdisjoint(changed)]
+        for key in dropped:
+            del self._entries[key]
+        return dropped
+
+    def clear(self):
+        self._entries.clear()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RuleSet(dict):
+    """
+    A generator's rules, as a dictionary from symbol to a list of productions. Every generator using the rules is told
+    about each write to the dictionary, so none of them keeps a compiled grammar or artifacts made from old rules.
+    Editing a list of productions in place isn't a write; call changed afterwards.
+    """
+    __slots__ = ("_listeners",)
+
+    def __init__(self, *args, **kwargs):
+        super(RuleSet, self).__init__(*args, **kwargs)
+        # Objects with a rules_edited method, taking the set of symbols that were written
+        self._listeners = weakref.WeakSet()
+
+    def __reduce__(self):
+        # Listeners stay with the original
+        return type(self), (dict(self),)
+
+    def listen(self, listener):
+        self._listeners.add(listener)
+
+    def forget(self, listener):
+        self._listeners.discard(listener)
+
+    def changed(self, symbols):
+        """
+        :param symbols: symbols whose productions were added, replaced, edited or removed
+        """
+        symbols = set(symbols)
+        if not symbols:
+            return
+        for listener in list(self._listeners):
+            listener.rules_edited(symbols)
+
+    def __setitem__(self, symbol, productions):
+        super(RuleSet, self).__setitem__(symbol, productions)
+        self.changed((symbol,))
+
+    def __delitem__(self, symbol):
+        super(RuleSet, self).__delitem__(symbol)
+        self.changed((symbol,))
+
+    def setdefault(self, symbol, default=None):
+        if symbol not in self:
+            self[symbol] = default
+        return self[symbol]
+
+    def pop(self, symbol, *default):
+        present = symbol in self
+        value = super(RuleSet, self).pop(symbol, *default)
+        if present:
+            self.changed((symbol,))
+        return value
+
+    def popitem(self):
+        item = super(RuleSet, self).popitem()
+        self.changed((item[0],))
+        return item
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        super(RuleSet, self).update(other)
+        self.changed(other.keys())
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        symbols = list(self.keys())
+        super(RuleSet, self).clear()
+        self.changed(symbols)
@@ -0,0 +1,117 @@
+from lark import Tree
+
+from gpsr_command_understanding.generator.tokens import WildCard
+
+
+def flatten_expression(tree):
+    """
+    Get the tokens of an expression tree as a flat tuple, inlining any nested expressions
+    :param tree: an expression tree, as produced by the grammar parser and expand_shorthand
+    :return: tuple of tokens in sentence order
+    """
+    tokens = []
+    for child in tree.children:
+        if isinstance(child, Tree):
+            if child.data not in ("expression", "top_expression"):
+                raise ValueError("Can't flatten {} subtree. Were the rules loaded with expand_shorthand?".format(child.data))
+            tokens.extend(flatten_expression(child))
+        else:
+            tokens.append(child)
+    return tuple(tokens)
+
+
+class Derivation(object):
+    """
+    An immutable, partially expanded sentence.
+
+    Terminals that have already been produced are kept in a linked list that grows backwards from the end
+    of the sentence, and symbols that still need to be expanded are kept in a linked list that grows from the front.
+    The leftmost open symbol is always at the head of the pending list, so expanding it only allocates cells for
+    the substituted production; the produced prefix and the pending suffix are shared with the parent derivation.
+    Cells are plain (value, next) tuples.
+    """
+    __slots__ = ("produced", "pending")
+
+    def __init__(self, produced, pending, rules):
+        # Move leading terminals over to the produced side so the next symbol to expand is at the head
+        while pending is not None and pending[0] not in rules:
+            produced = (pending[0], produced)
+            pending = pending[1]
+        self.produced = produced
+        self.pending = pending
+
+    @staticmethod
+    def start(tokens, rules):
+        pending = None
+        for token in reversed(tokens):
+            pending = (token, pending)
+        return Derivation(None, pending, rules)
+
+    @property
+    def next_symbol(self):
+        """
+        The leftmost symbol that still needs to be expanded, or None if the derivation is complete
+        """
+        return self.pending[0] if self.pending is not None else None
+
+    def expand(self, production, rules):
+        """
+        :param production: flat tuple of tokens to substitute for the next symbol
+        :param rules: anything that supports `in` for the tokens that still need expanding, e.g. the rules dictionary
+        :return: a new derivation that shares everything but the production with this one
+        """
+        pending = self.pending[1]
+        for token in reversed(production):
+            pending = (token, pending)
+        return Derivation(self.produced, pending, rules)
+
+    def tokens(self):
+        tokens = []
+        cell = self.produced
+        while cell is not None:
+            tokens.append(cell[0])
+            cell = cell[1]
+        tokens.reverse()
+        cell = self.pending
+        while cell is not None:
+            tokens.append(cell[0])
+            cell = cell[1]
+        return tokens
+
+    def to_tree(self):
+        return Tree("expression", self.tokens())
+
+
+def is_void(token):
+    return isinstance(token, WildCard) and token.name == "void"
+
+
+class IndexedSentence(object):
+    """
+    A flat, immutable sentence that knows where its open symbols are.
+
+    The frontier holds the positions of every token that still needs to be expanded, in sentence order, so picking
+    the next symbol is a lookup instead of a scan over the whole tree. Productions are indexed the same way once
+    when the rules are loaded, and substituting one shifts the frontier rather than recomputing it.
+    """
+    __slots__ = ("tokens", "frontier")
+
+    def __init__(self, tokens, frontier):
+        self.tokens = tokens
+        self.frontier = frontier
+
+    def substitute(self, which, production):
+        """
+        :param which: index into the frontier of the symbol to replace
+        :param production: an IndexedSentence to put in its place
+        :return: a new IndexedSentence
+        """
+        position = self.frontier[which]
+        shift = len(production.tokens) - 1
+        tokens = self.tokens[:position] + production.tokens + self.tokens[position + 1:]
+        frontier = self.frontier[:which] + tuple(position + i for i in production.frontier) + tuple(
+            i + shift for i in self.frontier[which + 1:])
+        return IndexedSentence(tokens, frontier)
+
+    def to_tree(self):
+        return Tree("expression", list(self.tokens))
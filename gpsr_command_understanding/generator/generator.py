@@ -1,34 +1,108 @@
-import copy
+import itertools
 import re
-from collections import defaultdict
+import time
+from random import Random
 from string import printable
 
-import importlib_resources
-from lark import Lark, Tree, exceptions
+from lark import Tree, exceptions
 
-from gpsr_command_understanding.generator.grammar import TypeConverter, expand_shorthand, NonTerminal, \
-    CombineExpressions, DiscardVoid, ComplexWildCard
-from gpsr_command_understanding.util import replace_child_in_tree, \
-    get_wildcards, has_nonterminals, ParseForward
+from gpsr_command_understanding.generator.grammar import expand_shorthand, NonTerminal, DiscardVoid, ComplexWildCard, \
+    SemanticsTemplate
+from gpsr_command_understanding.generator.compiled_grammar import CompiledGrammar
+from gpsr_command_understanding.generator.counting import DerivationCounter, DerivationSampler
+from gpsr_command_understanding.generator.dependencies import DerivedArtifacts, RuleSet, rule_dependencies, reachable, \
+    dependents
+from gpsr_command_understanding.generator.derivation import Derivation, flatten_expression
+from gpsr_command_understanding.generator.rule_cache import describe
+from gpsr_command_understanding.generator.parser_registry import GENERATOR_GRAMMARS, generator_parser, \
+    generator_file_parser  # noqa: F401
+from gpsr_command_understanding.util import get_wildcards, has_nonterminals, ParseForward
 
-GENERATOR_GRAMMARS = {2018: importlib_resources.read_text("gpsr_command_understanding.resources", "generator.lark"),
-                      2019: importlib_resources.read_text("gpsr_command_understanding.resources", "generator.lark"),
-                      2021: importlib_resources.read_text("gpsr_command_understanding.resources", "generator.lark")}
+# Some grammar files have annoying byte order markers and other non-printable characters attached
+NON_PRINTABLE = re.compile("[^{}]+".format(printable))
+
+# Most assignments generate_groundings applies at once
+GROUNDING_BATCH_SIZE = 256
 
 
 # TODO(nickswalker): Document these methods
 class Generator:
     def __init__(self, knowledge_base, grammar_format_version=2018):
         self._grammar_format_version = grammar_format_version
-        grammar_spec = GENERATOR_GRAMMARS[grammar_format_version]
-        self.__grammar_parser = Lark(grammar_spec,
-                                     start=['rule_start', 'expression_start'], parser="lalr",
-                                     transformer=TypeConverter())
+        self.__grammar_parser = generator_parser(grammar_format_version)
         self.rule_parser = ParseForward(self.__grammar_parser, "rule_start")
         self.sequence_parser = ParseForward(self.__grammar_parser, "expression_start")
+        self.file_parser = generator_file_parser(grammar_format_version)
+        # Values computed from the rules. See derived
+        self.artifacts = DerivedArtifacts()
+        # Parsed rule lines from the last reload_rules, keyed by (expand_shorthand, line)
+        self._rule_lines = {}
+        self._rules = None
         self.rules = {}
         self.knowledge_base = knowledge_base
 
+    @property
+    def rules(self):
+        """
+        Dictionary from each symbol to its list of productions. Writes to it are noticed by every generator sharing it;
+        after editing a list of productions in place, call rules.changed with the symbols.
+        :return: RuleSet
+        """
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        """
+        :param rules: a RuleSet is shared as is. Any other dictionary is copied into a new RuleSet
+        """
+        if not isinstance(rules, RuleSet):
+            rules = RuleSet(rules)
+        if self._rules is not None:
+            self._rules.forget(self)
+        rules.listen(self)
+        self._rules = rules
+        self._compiled = None
+        self._dependencies = None
+        self.artifacts.clear()
+
+    def rules_edited(self, symbols):
+        """
+        Called by the rules whenever some of their entries are written
+        :param symbols: set of symbols that changed
+        """
+        self._compiled = None
+        self._dependencies = None
+        self.artifacts.invalidate(symbols)
+
+    @property
+    def dependencies(self):
+        """
+        Dependency graph over the rules. Rebuilt lazily whenever rules are loaded or replaced.
+        :return: dictionary from each symbol with productions to the set of nonterminals they use
+        """
+        if self._dependencies is None:
+            self._dependencies = rule_dependencies(self.rules)
+        return self._dependencies
+
+    def derived(self, key, roots, build):
+        """
+        Compute a value from the rules once and keep it until a rule it could depend on is reloaded
+        :param key: names the value
+        :param roots: symbols the value is computed from. Everything they can derive is a dependency too
+        :param build: called with no arguments to make the value
+        """
+        return self.artifacts.get(key, reachable(self.dependencies, roots), build)
+
+    @property
+    def compiled(self):
+        """
+        The rules with every symbol interned to an integer ID. Rebuilt lazily whenever rules are loaded or replaced.
+        :return: CompiledGrammar
+        """
+        if self._compiled is None:
+            self._compiled = CompiledGrammar(self.rules)
+        return self._compiled
+
     def parse_production_rule(self, line, expand=True):
         try:
             parsed = self.rule_parser.parse(line)
@@ -45,36 +119,95 @@ class Generator:
         # print(parsed.pretty())
         return parsed.children[0], rhs_list_expanded
 
-    def load_rules(self, grammar_files, expand_shorthand=True):
+    def parse_rule_file(self, text, expand=True):
+        """
+        Parse every rule in a grammar file at once
+        :param text: the whole file. Comments and blank lines are skipped
+        :return: list of (lhs, productions) in file order, one for each rule line
+        """
+        text = NON_PRINTABLE.sub("", text)
+        try:
+            parsed = self.file_parser.parse(text)
+        except exceptions.LarkError as e:
+            if isinstance(e, exceptions.UnexpectedInput):
+                print("Couldn't load line: " + text.split("\n")[e.line - 1].strip())
+            raise e
+
+        rules = []
+        for rule in parsed.children:
+            rhs = rule.children[1]
+            rules.append((rule.children[0], expand_shorthand(rhs) if expand else [rhs]))
+        return rules
+
+    def load_rules(self, grammar_files, expand_shorthand=True, timings=None):
         """
         :param grammar_files: list of files
+        :param timings: optional list. The seconds spent loading each file are appended to it
         :return: dictionary with NonTerminal key and values for all productions
         """
         if not isinstance(grammar_files, list):
             grammar_files = [grammar_files]
 
         i = 0
+        loaded = set()
         for grammar_file in grammar_files:
-            for line in grammar_file:
-                # Scrub out any non-printable characters; some grammar files have annoying byte order
-                # markers attached
-                line = line.strip()
-                line = re.sub("[^{}]+".format(printable), "", line)
-                # parse into possible productions
-                lhs, rhs_productions = self.parse_production_rule(line, expand_shorthand)
-                # Skip emtpy LHS (comments)
+            start = time.perf_counter()
+            # Each file is parsed in one pass, rather than line by line
+            for lhs, rhs_productions in self.parse_rule_file("\n".join(grammar_file), expand_shorthand):
                 # add to dictionary, if already there then append to list of rules
-                # using set to avoid duplicates
-                if not lhs:
-                    continue
-                elif lhs not in self.rules:
-                    self.rules[lhs] = rhs_productions
-                    i += 1
-                else:
-                    self.rules[lhs].extend(rhs_productions)
-                    i += 1
+                self.rules.setdefault(lhs, []).extend(rhs_productions)
+                loaded.add(lhs)
+                i += 1
+            if timings is not None:
+                timings.append(time.perf_counter() - start)
+        self.rules.changed(loaded)
         return i
 
+    def reload_rules(self, grammar_files, expand_shorthand=True):
+        """
+        Make the rules exactly what grammar_files define, changing only the entries that differ. Lines that were
+        already there at the last reload aren't parsed or expanded again, and only the derived artifacts that depend
+        on a changed symbol are dropped. Symbols that are new go at the end of rules.
+        :param grammar_files: list of files
+        :return: set of symbols whose derivations may have changed
+        """
+        if not isinstance(grammar_files, list):
+            grammar_files = [grammar_files]
+
+        rules = {}
+        lines = {}
+        for grammar_file in grammar_files:
+            for line in grammar_file:
+                key = (expand_shorthand, NON_PRINTABLE.sub("", line.strip()))
+                parsed = self._rule_lines.get(key)
+                if parsed is None:
+                    # Same parser as load_rules. Comments and blank lines come back empty
+                    parsed = self.parse_rule_file(key[1], expand_shorthand)
+                lines[key] = parsed
+                for lhs, rhs_productions in parsed:
+                    rules.setdefault(lhs, []).extend(rhs_productions)
+        # Lines that were removed are forgotten
+        self._rule_lines = lines
+
+        # Wildcards don't compare their metadata, so compare descriptions. Otherwise a metadata edit isn't a change
+        changed = {symbol for symbol in self.rules.keys() | rules.keys()
+                   if describe(self.rules.get(symbol)) != describe(rules.get(symbol))}
+        if not changed:
+            return changed
+        old_dependencies = self.dependencies
+        new_dependencies = dict(old_dependencies)
+        new_dependencies.update(rule_dependencies({symbol: rules[symbol] for symbol in changed if symbol in rules}))
+        # Edits can add or remove uses, so anything that used a changed symbol before or after is affected
+        affected = dependents(old_dependencies, changed) | dependents(new_dependencies, changed)
+
+        # Update in place, so every generator sharing the rules (e.g. a PairedGenerator made from this one) is told
+        self.rules.update({symbol: rules[symbol] for symbol in changed if symbol in rules})
+        for symbol in changed - rules.keys():
+            del self.rules[symbol]
+            del new_dependencies[symbol]
+        self._dependencies = new_dependencies
+        return affected
+
     def ground(self, tree, **kwargs):
         """
         Get a grounding for a tree
@@ -83,136 +216,394 @@ class Generator:
         """
         return next(self.generate_groundings(tree, **kwargs))
 
-    def generate_groundings(self, tree, random_generator=None, ignore_types=False, apply_obfuscation=True):
-        assignments = self.generate_grounding_assignments(tree, random_generator=random_generator,
-                                                          ignore_types=ignore_types)
-        for assignment in assignments:
-            yield self.apply_grounding_assignment(tree, assignment, apply_obfuscation=apply_obfuscation)
+    def generate_groundings(self, tree, random_generator=None, ignore_types=False, apply_obfuscation=True, count=None):
+        """
+        :param random_generator: if set, groundings come in random order (see sample_grounding_assignments). Otherwise
+            they come in knowledge base order
+        :param count: stop after this many groundings
+        """
+        assignments = self._assignments(tree, random_generator, ignore_types, count)
+        # Assignments are applied in batches so obfuscations are looked up a column at a time. Batches start small so
+        # taking only the first few groundings (like ground does) stays cheap
+        batch_size = 1
+        while True:
+            batch = list(itertools.islice(assignments, batch_size))
+            if not batch:
+                return
+            yield from self.apply_grounding_assignments(tree, batch, apply_obfuscation=apply_obfuscation)
+            batch_size = min(2 * batch_size, GROUNDING_BATCH_SIZE)
+
+    def _assignments(self, tree, random_generator, ignore_types, count):
+        if random_generator:
+            return self.sample_grounding_assignments(tree, random_generator, count=count, ignore_types=ignore_types)
+        return itertools.islice(self.generate_grounding_assignments(tree, ignore_types=ignore_types), count)
 
     def apply_grounding_assignment(self, tree, assignment, apply_obfuscation=True):
-        grounded = copy.deepcopy(tree)
-        for wildcard, replacement in assignment.items():
-            if apply_obfuscation and isinstance(wildcard, ComplexWildCard) and wildcard.obfuscated:
-                replacement = self.obfuscate(wildcard, replacement)
-            replace_child_in_tree(grounded, wildcard, replacement)
+        return self.apply_grounding_assignments(tree, [assignment], apply_obfuscation=apply_obfuscation)[0]
+
+    def apply_grounding_assignments(self, tree, assignments, apply_obfuscation=True):
+        """
+        Ground a tree once for each assignment. Each obfuscated wildcard's groundings are obfuscated together
+        :param assignments: list of maps from the tree's wildcards to groundings, all with the same wildcards
+        :return: list of new trees, one per assignment
+        """
+        obfuscations = {}
+        if apply_obfuscation and assignments:
+            for wildcard in assignments[0].keys():
+                if isinstance(wildcard, ComplexWildCard) and wildcard.obfuscated:
+                    obfuscations[wildcard] = self.obfuscate_all(wildcard, [assignment[wildcard] for assignment in assignments])
+        grounded = []
+        for i, assignment in enumerate(assignments):
+            substitutions = tuple((wildcard, obfuscations[wildcard][i] if wildcard in obfuscations else replacement)
+                                  for wildcard, replacement in assignment.items())
+            grounded.append(SemanticsTemplate(tree, substitutions).to_tree())
         return grounded
 
     def obfuscate(self, wildcard, grounding):
-        if wildcard.name == "object":
-            # What's the category of this object?
-            obj_category_name = self.knowledge_base.attributes["object"]["category"][grounding]
-            obj_cat_singular = self.knowledge_base.attributes["category"]["singular"][obj_category_name]
-            return obj_cat_singular
-        elif wildcard.name == "category":
-            return "objects"
-        elif wildcard.name == "location":
-            if wildcard.type == "room":
-                return "room"
-            else:
-                # What room is this beacon or placement in?
-                return self.knowledge_base.attributes["location"]["in"][grounding]
+        return self.knowledge_base.obfuscate(wildcard.name, grounding, wildcard.type)
 
-    def generate_grounding_assignments(self, tree, random_generator=None, ignore_types=False):  # noqa: C901
+    def obfuscate_all(self, wildcard, groundings):
+        """
+        :param groundings: list of items the wildcard was grounded to
+        :return: list of what the obfuscated wildcard says instead of each
+        """
+        return self.knowledge_base.obfuscate_all(wildcard.name, groundings, wildcard.type)
+
+    def generate_grounding_assignments(self, tree, random_generator=None, ignore_types=False):
         """
         Generate maps from a tree's wildcards to valid entities in the knowledgebase
         :param tree:
         :param random_generator:
         :param ignore_types:
         """
-        wildcards = get_wildcards(tree)
-        assignment = {}
+        wildcards, order, different_from, attribute_constraints = self._grounding_constraints(tree, ignore_types)
+        domains = self._grounding_domains(wildcards, order, attribute_constraints)
+        earlier = self._earlier_slots(order, different_from)
+        if not self._could_be_satisfied(wildcards, order, domains, earlier):
+            return
+        yield from self.__populate_with_constraints(wildcards, order, domains, earlier, random_generator=random_generator)
+
+    def sample_grounding_assignments(self, tree, random_generator, count=None, ignore_types=False, max_rejections=100):  # noqa: C901
+        """
+        Draw distinct assignments at random. Each draw picks an index into every slot's domain and throws the whole
+        assignment away if it breaks a constraint or was already drawn, so the assignments are uniform over the ones
+        not yet drawn and a draw doesn't depend on the size of the knowledge base. Once half of the space of draws
+        is used up, or after max_rejections rejections in a row, the rest come from a randomized search instead,
+        which skips what was already drawn.
+        :param tree:
+        :param random_generator:
+        :param count: stop after this many assignments. By default, stop when every assignment has been drawn
+        :param ignore_types:
+        :param max_rejections:
+        """
+        wildcards, order, different_from, attribute_constraints = self._grounding_constraints(tree, ignore_types)
+        domains = self._grounding_domains(wildcards, order, attribute_constraints)
+        earlier = self._earlier_slots(order, different_from)
+        if not self._could_be_satisfied(wildcards, order, domains, earlier):
+            return
+        # At least as many as there are assignments. Counting them exactly costs more than the draws
+        bound = 1
+        for slot in order:
+            bound *= len(domains[slot])
+        output_slots = sorted(order)
+        keys = [wildcards[slot] for slot in output_slots]
+        slots = [(slot, domains[slot], len(domains[slot]), earlier[slot]) for slot in order]
+        values = [None] * len(wildcards)
+        drawn = set()
+        rejections = 0
+        while (count is None or len(drawn) < count) and 2 * len(drawn) < bound and rejections < max_rejections:
+            for slot, domain, size, must_differ in slots:
+                value = domain[random_generator.randrange(size)]
+                if any(value == values[other] for other in must_differ):
+                    break
+                values[slot] = value
+            else:
+                assignment = tuple(values[slot] for slot in output_slots)
+                if assignment not in drawn:
+                    drawn.add(assignment)
+                    rejections = 0
+                    yield dict(zip(keys, assignment))
+                    continue
+            rejections += 1
+        if len(drawn) == count:
+            return
+
+        for assignment in self.__populate_with_constraints(wildcards, order, domains, earlier,
+                                                           random_generator=random_generator):
+            values = tuple(assignment[key] for key in keys)
+            if values in drawn:
+                continue
+            drawn.add(values)
+            yield assignment
+            if len(drawn) == count:
+                return
+
+    def count_grounding_assignments(self, tree, ignore_types=False):
+        """
+        The number of assignments generate_grounding_assignments would produce, without producing them
+        :param tree:
+        :param ignore_types:
+        """
+        wildcards, order, different_from, attribute_constraints = self._grounding_constraints(tree, ignore_types)
+        position = {slot: i for i, slot in enumerate(order)}
+        domains = self._grounding_domains(wildcards, order, attribute_constraints)
+        earlier = self._earlier_slots(order, different_from)
+
+        # Slots that aren't linked by a constraint can be counted separately
+        component_of = {}
+        components = []
+        for slot in order:
+            linked = set(component_of[other] for other in earlier[slot])
+            merged = [slot]
+            for component in sorted(linked):
+                merged = components[component] + merged
+                components[component] = None
+            merged.sort(key=position.get)
+            for member in merged:
+                component_of[member] = len(components)
+            components.append(merged)
+
+        total = 1
+        for component in components:
+            if component is None:
+                continue
+            total *= self._count_component(component, domains, earlier)
+            if total == 0:
+                break
+        return total
+
+    def count_groundings(self, trees, ignore_types=False):
+        """
+        Exact grounding counts for many templates, for budgeting before grounding any of them. Nothing is grounded;
+        see generate_grounding_assignments to stream the assignments themselves
+        :param trees: iterable of ungrounded trees
+        :param ignore_types:
+        :return: list with the number of assignments of each tree, in order
+        """
+        return [self.count_grounding_assignments(tree, ignore_types=ignore_types) for tree in trees]
+
+    @staticmethod
+    def _count_component(slots, domains, earlier):
+        first_domain = set(domains[slots[0]])
+        everything_differs = all(len(earlier[slot]) == i for i, slot in enumerate(slots))
+        if everything_differs and all(len(domains[slot]) == len(first_domain) and set(domains[slot]) == first_domain
+                                      for slot in slots):
+            # Picking distinct values from the same pool
+            count = 1
+            for i in range(len(slots)):
+                count *= max(len(first_domain) - i, 0)
+            return count
+
+        values = {}
+
+        def count_from(i):
+            if i == len(slots):
+                return 1
+            slot = slots[i]
+            count = 0
+            for candidate in domains[slot]:
+                if any(candidate == values[other] for other in earlier[slot]):
+                    continue
+                values[slot] = candidate
+                count += count_from(i + 1)
+            return count
+
+        return count_from(0)
+
+    def _grounding_constraints(self, tree, ignore_types):  # noqa: C901
+        """
+        :return: tuple of the distinct wildcards, the order to fill their slots in, the slots each slot must
+            differ from, and the (attribute, value) pairs each slot's value must have
+        """
+        occurrences = list(get_wildcards(tree))
+        # Each distinct wildcard gets an integer slot. Constraints are kept per slot as the slots of wildcards that
+        # must differ from it, plus (attribute, value) pairs
+        slots = {}
+        wildcards = []
+        different_from = []
+        attribute_constraints = []
 
-        constraints = defaultdict(set)
-        for wildcard in wildcards:
+        for wildcard in occurrences:
             if "pron" in wildcard.name:
                 # FIXME(nickswalker): Something here about pointing to the nearest name
                 continue
+            slot = slots.get(wildcard)
+            if slot is None:
+                slot = len(wildcards)
+                slots[wildcard] = slot
+                wildcards.append(wildcard)
+                different_from.append(None)
+                attribute_constraints.append(None)
             # IDs impose uniqueness constraints.
+            if wildcard.id:
+                # Any wildcard of the same name with a different ID needs to be different
+                different_from[slot] = [other for other, other_wildcard in enumerate(wildcards)
+                                        if other_wildcard.name == wildcard.name and other_wildcard.id != wildcard.id]
             else:
-                if wildcard.id:
-                    constraints[wildcard] = set()
-                    # Could be another instance of the same wildcard. It's constrained already so skip it
-                    if wildcard in assignment:
-                        continue
-                    for other_wildcard, item_constraints in constraints.items():
-                        # Any wildcard of the same name with a different ID needs to be different
-                        if other_wildcard.name == wildcard.name and other_wildcard.id != wildcard.id:
-                            constraints[wildcard].add(other_wildcard)
-                else:
-                    constraints[wildcard] = set()
-                    # No id, so implicitly unique wrt to all wildcards with the same name
-                    for other_wildcard, item_constraints in constraints.items():
-                        # Any wildcard of the same name with a different ID needs to be different
-                        if other_wildcard != wildcard and other_wildcard.name == wildcard.name:
-                            constraints[wildcard].add(other_wildcard)
-                if ignore_types and wildcard.type != "room":
-                    continue
-                if wildcard.name == "object" and wildcard.type:
-                    constraints[wildcard].add(("type", wildcard.type))
-                elif wildcard.name == "location" and wildcard.type:
-                    # Location types are a shorthand for an attribute: ex isplacement
-                    constraints[wildcard].add(("is" + wildcard.type, True))
-                if wildcard.conditions:
-                    for key, value in wildcard.conditions.items():
-                        constraints[wildcard].add((key, value))
-
-        yield from self.__populate_with_constraints(tree, constraints, random_generator=random_generator,
-                                                    ignore_types=ignore_types)
-
-    def __populate_with_constraints(self, tree, constraints, random_generator=None):  # noqa: C901
-        wildcards = get_wildcards(tree)
-        if not wildcards:
-            # Should've assigned something for every constraint
-            assert len(constraints.values()) == len(constraints)
-            yield constraints
-            return
-        wildcard = next(wildcards)
-        item_constraints = constraints[wildcard]
+                # No id, so implicitly unique wrt to all wildcards with the same name
+                different_from[slot] = [other for other, other_wildcard in enumerate(wildcards)
+                                        if other_wildcard != wildcard and other_wildcard.name == wildcard.name]
+            attribute_constraints[slot] = []
+            if ignore_types and wildcard.type != "room":
+                continue
+            if wildcard.name == "object" and wildcard.type:
+                attribute_constraints[slot].append(("type", wildcard.type))
+            elif wildcard.name == "location" and wildcard.type:
+                # Location types are a shorthand for an attribute: ex isplacement
+                attribute_constraints[slot].append(("is" + wildcard.type, True))
+            if wildcard.conditions:
+                for key, value in wildcard.conditions.items():
+                    attribute_constraints[slot].append((key, value))
+
+        # Fill slots in the order their wildcards first appear. Filling a wildcard fills every occurrence of it
+        order = []
+        for wildcard in occurrences:
+            if any(wildcard == wildcards[slot] for slot in order):
+                continue
+            slot = slots.get(wildcard)
+            if slot is None:
+                # Pronouns aren't constrained, but they still need to be filled
+                slot = len(wildcards)
+                slots[wildcard] = slot
+                wildcards.append(wildcard)
+                different_from.append([])
+                attribute_constraints.append([])
+            order.append(slot)
+        return wildcards, order, different_from, attribute_constraints
+
+    def _grounding_candidates(self, wildcard):
         # What things are possibilities to fill this slot?
         if wildcard.name == "pron":
-            candidates = ["them"]
+            return ["them"]
         elif wildcard.name == "pron paj":
-            candidates = ["their"]
-        else:
-            candidates = self.knowledge_base.by_name[wildcard.name]
-        if random_generator:
-            random_generator.shuffle(candidates)
-        # Now we'll try to fill in the wildcard with the candidate
-        for candidate in candidates:
-            if not isinstance(item_constraints, set):
-                # We should have already replaced this wildcard if it has a fixed constraint
-                assert False
-            valid = True
-            for constraint in item_constraints:
-                if isinstance(constraint, ComplexWildCard):
-                    # Constraints only point backwards, so this constraint is saying that current wildcard
-                    # must be different from a previously fixed value
-                    if candidate == constraints[constraint]:
-                        valid = False
-                elif isinstance(constraint, tuple):
-                    # This is some attribute that must have a certain value
-                    attribute_name, value = constraint
-                    attributes_for_type = self.knowledge_base.attributes[wildcard.name]
-                    if attribute_name not in attributes_for_type.keys():
-                        raise RuntimeError(
-                            attribute_name + " is not a valid attribute for wildcard type " + wildcard.name)
-                    if attributes_for_type[attribute_name].get(candidate) != value:
-                        valid = False
-            if not valid:
+            return ["their"]
+        return self.knowledge_base.by_name[wildcard.name]
+
+    def _grounding_domains(self, wildcards, order, attribute_constraints):
+        """
+        :return: dictionary from slot to the candidates that satisfy its attribute constraints, in knowledge base order
+        """
+        domains = {}
+        for slot in order:
+            wildcard = wildcards[slot]
+            if not attribute_constraints[slot]:
+                domains[slot] = list(self._grounding_candidates(wildcard))
+                continue
+            # The knowledge base's indexes give everything that matches in one set
+            matches = self.knowledge_base.with_attributes(wildcard.name, attribute_constraints[slot])
+            domains[slot] = [candidate for candidate in self._grounding_candidates(wildcard) if candidate in matches]
+        return domains
+
+    @staticmethod
+    def _earlier_slots(order, different_from):
+        # Constraints are only checked against slots that were filled earlier
+        position = {slot: i for i, slot in enumerate(order)}
+        return {slot: [other for other in different_from[slot] if position[other] < position[slot]] for slot in order}
+
+    @staticmethod
+    def _could_be_satisfied(wildcards, order, domains, earlier):
+        """
+        Cheap checks that rule out trees with no assignments before any search: an empty domain, or more wildcards
+        of a name that must all differ than there are values among their domains
+        """
+        if any(len(domains[slot]) == 0 for slot in order):
+            return False
+        by_name = {}
+        for slot in order:
+            by_name.setdefault(wildcards[slot].name, []).append(slot)
+        for slots in by_name.values():
+            if len(slots) < 2:
                 continue
-            # This candidate doesn't violate a constraint -> recurse on it
-            fixed = copy.deepcopy(constraints)
-            fresh_tree = copy.deepcopy(tree)
-            fixed[wildcard].clear()
-            fixed[wildcard] = candidate
-            replace_child_in_tree(fresh_tree, wildcard, candidate)
-            yield from self.__populate_with_constraints(fresh_tree, fixed, random_generator=random_generator)
+            all_differ = all(set(slots[:i]).issubset(earlier[slot]) for i, slot in enumerate(slots))
+            if all_differ and len(set().union(*(domains[slot] for slot in slots))) < len(slots):
+                return False
+        return True
+
+    def __populate_with_constraints(self, wildcards, order, domains, earlier, random_generator=None):  # noqa: C901
+        """
+        Backtracking search over the slots' domains. Filling a slot rules its value out of the later slots that must
+        differ from it (forward checking), and a value that would leave one of them with nothing is skipped right away.
+        Assignments come out in the same order as trying every candidate in turn would give
+        """
+        later = {slot: [] for slot in order}
+        for slot in order:
+            for other in earlier[slot]:
+                later[other].append(slot)
+        allowed = {slot: set(domains[slot]) for slot in order}
+        # How many filled slots rule each value out of a slot, and how much of the slot's domain is left
+        ruled_out = {slot: {} for slot in order}
+        remaining = {slot: len(allowed[slot]) for slot in order}
+        values = [None] * len(wildcards)
+        keys = [wildcards[slot] for slot in sorted(order)]
+        output_slots = sorted(order)
+        last = len(order) - 1
+
+        def fill(position):
+            if position > last:
+                yield dict(zip(keys, [values[slot] for slot in output_slots]))
+                return
+            slot = order[position]
+            if random_generator:
+                # Shuffle a copy. The knowledge base's lists stay in order
+                candidates = list(domains[slot])
+                random_generator.shuffle(candidates)
+            else:
+                candidates = domains[slot]
+            excluded = ruled_out[slot]
+            for candidate in candidates:
+                if excluded.get(candidate):
+                    continue
+                if position == last:
+                    # Nothing comes after, so there's nothing to check forward
+                    values[slot] = candidate
+                    yield dict(zip(keys, [values[slot] for slot in output_slots]))
+                    continue
+                touched = []
+                wiped_out = False
+                for other in later[slot]:
+                    if candidate not in allowed[other]:
+                        continue
+                    other_excluded = ruled_out[other]
+                    count = other_excluded.get(candidate, 0)
+                    other_excluded[candidate] = count + 1
+                    touched.append(other)
+                    if count == 0:
+                        remaining[other] -= 1
+                        if remaining[other] == 0:
+                            wiped_out = True
+                if not wiped_out:
+                    values[slot] = candidate
+                    yield from fill(position + 1)
+                for other in touched:
+                    other_excluded = ruled_out[other]
+                    other_excluded[candidate] -= 1
+                    if other_excluded[candidate] == 0:
+                        remaining[other] += 1
+            values[slot] = None
+
+        return fill(0)
 
     def generate_random(self, start_symbols, random_generator=None):
         return next(
             self.generate(start_symbols,
                           branch_cap=1, random_generator=random_generator))
 
+    def sample_uniform(self, start_tree, random_generator=None, weights=None):
+        """
+        An endless generator of sentences drawn uniformly from everything enumerate would produce. Unlike
+        generate_random, short derivations aren't favored
+        :param start_tree: the list of tokens to begin expanding
+        :param random_generator: source of randomness. A fresh Random if not given
+        :param weights: optional dictionary from symbol to a weight for each of its productions, to skew the sampling
+        """
+        if random_generator is None:
+            random_generator = Random()
+        compiled = self.compiled
+        start = compiled.compile_tokens(self._start_tokens(start_tree)).tokens
+        sampler = DerivationSampler(DerivationCounter(compiled), weights=weights)
+        while True:
+            yield Tree("expression", compiled.to_tokens(sampler.sample(start, random_generator)))
+
     def generate(self, start_tree, branch_cap=None, random_generator=None):
         """
         A generator that produces completely expanded sentences in depth-first order
@@ -220,47 +611,120 @@ class Generator:
         :param random_generator: optional source of randomness to use in branching decisions. Deterministic otherwise
         :param branch_cap: limit on the number of different branches to pursue
         """
-        # Make sure the start point is a Tree
-        if isinstance(start_tree, NonTerminal):
-            stack = [Tree("expression", [start_tree])]
-        elif isinstance(start_tree, list):
-            stack = [Tree("expression", start_tree)]
-        else:
-            stack = [start_tree]
+        compiled = self.compiled
+        index = compiled.productions
+        start = compiled.compile_tokens(self._start_tokens(start_tree))
+        # Nesting depth of each frontier symbol. Only random branching needs it; see _replaced_occurrence
+        stack = [(start, (0,) * len(start.frontier))]
+        # Random branching without a cap keeps reshuffling the same orders, so repeated expansions of a symbol
+        # draw a fresh permutation of the previous one
+        shuffled = {}
 
         while len(stack) != 0:
-            sentence = stack.pop()
-            replace_tokens = list(sentence.scan_values(lambda x: x in self.rules.keys()))
+            sentence, depths = stack.pop()
 
-            if replace_tokens:
+            if sentence.frontier:
                 if random_generator:
-                    replace_token = random_generator.choice(replace_tokens)
-                    productions = self.rules[replace_token]
+                    which = random_generator.randrange(len(sentence.frontier))
+                    which = self._replaced_occurrence(sentence, depths, which)
+                    replace_id = sentence.tokens[sentence.frontier[which]]
+                    productions = index[replace_id]
                     if branch_cap:
                         productions = random_generator.sample(productions, k=min(branch_cap, len(productions)))
                     else:
                         # Use all of the branches
-                        productions = self.rules[replace_token]
+                        productions = shuffled.setdefault(replace_id, list(productions))
                         random_generator.shuffle(productions)
                 else:
-                    replace_token = replace_tokens[0]
-                    productions = self.rules[replace_token]
+                    which = 0
+                    productions = index[sentence.tokens[sentence.frontier[0]]]
                     if branch_cap:
                         productions = productions[:min(branch_cap, len(productions))]
 
                 # Replace it every way we know how
                 for production in productions:
-                    modified_sentence = copy.deepcopy(sentence)
-                    replace_child_in_tree(modified_sentence, replace_token, production, only_once=True)
                     # Generate the rest of the sentence recursively assuming this replacement
-                    stack.append(modified_sentence)
+                    if random_generator:
+                        production_depths = (depths[which] + 1,) * len(production.frontier)
+                        stack.append((sentence.substitute(which, production),
+                                      depths[:which] + production_depths + depths[which + 1:]))
+                    else:
+                        stack.append((sentence.substitute(which, production), depths))
             else:
                 # If we couldn't replace anything else, this sentence is done!
-                sentence = CombineExpressions().visit(sentence)
+                sentence = compiled.to_tree(sentence)
                 # If we have unexpanded non-terminals, something is wrong with the rules
                 assert not has_nonterminals(sentence)
                 yield sentence
 
+    @staticmethod
+    def _replaced_occurrence(sentence, depths, which):
+        """
+        Sentences used to be nested trees, and the first match for the chosen symbol was replaced in the order that
+        Tree.iter_subtrees visits: deepest subtrees first, left to right. Pick the same occurrence so that seeded runs
+        keep producing the same sentences.
+        :param depths: nesting depth of each frontier symbol
+        :param which: index into the frontier of the randomly chosen symbol
+        :return: index into the frontier of the occurrence to replace
+        """
+        symbol = sentence.tokens[sentence.frontier[which]]
+        replaced = None
+        for i, position in enumerate(sentence.frontier):
+            if sentence.tokens[position] == symbol and (replaced is None or depths[i] > depths[replaced]):
+                replaced = i
+        return replaced
+
+    @staticmethod
+    def _start_tokens(start_tree):
+        if isinstance(start_tree, NonTerminal):
+            return (start_tree,)
+        elif isinstance(start_tree, list):
+            return flatten_expression(Tree("expression", start_tree))
+        return flatten_expression(start_tree)
+
+    def enumerate(self, start_tree, branch_cap=None):
+        """
+        Produces the same sentences in the same order as a deterministic call to generate, but expands persistent
+        partial derivations instead of deep copying the whole sentence for every production.
+        Use this for full-grammar enumeration.
+        :param start_tree: the list of tokens to begin expanding
+        :param branch_cap: limit on the number of different branches to pursue
+        """
+        return self.enumerate_from([self.start_derivation(start_tree)], branch_cap=branch_cap)
+
+    def count_derivations(self, start_tree, branch_cap=None):
+        """
+        The number of sentences enumerate would produce, computed without producing them. Cycles in the rules are
+        reported, and make the count math.inf
+        :param start_tree: the list of tokens to begin expanding
+        :param branch_cap: limit on the number of different branches to pursue
+        """
+        compiled = self.compiled
+        counter = DerivationCounter(compiled, branch_cap=branch_cap)
+        count = counter.count_sequence(compiled.compile_tokens(self._start_tokens(start_tree)).tokens)
+        for cycle in counter.cycles:
+            print("Rules have a cycle: " + " -> ".join(symbol.to_human_readable() for symbol in cycle))
+        return count
+
+    def start_derivation(self, start_tree):
+        compiled = self.compiled
+        return Derivation.start(compiled.compile_tokens(self._start_tokens(start_tree)).tokens, compiled.open_ids)
+
+    def enumerate_from(self, stack, branch_cap=None):
+        """
+        Continue an enumeration from a stack of derivations.
+        :param stack: list of derivations still to expand, last one first. It's updated in place, and whenever a
+                      sentence is yielded it holds exactly the work that remains, so a copy taken then can be used
+                      to resume later with the same rules
+        :param branch_cap: limit on the number of different branches to pursue
+        """
+        compiled = self.compiled
+        for ids in compiled.derive(stack, branch_cap=branch_cap):
+            sentence = Tree("expression", compiled.to_tokens(ids))
+            # If we have unexpanded non-terminals, something is wrong with the rules
+            assert not has_nonterminals(sentence)
+            yield sentence
+
     def extract_metadata(self, tree):
         """
         Remove wildcard metadata from the tree and list it in another object
@@ -269,17 +733,24 @@ class Generator:
         """
         # Process metadata on wildcards
         sentence_metadata = {}
-        wildcards = list(tree.scan_values(lambda x: isinstance(x, ComplexWildCard)))
-        for wildcard in wildcards:
-            card_meta = wildcard.metadata
-            if wildcard.name == "void":
-                # These are going to get removed, so key by index
-                index = tree.children.index(wildcard)
 
-            else:
-                index = wildcard
-            sentence_metadata[index] = card_meta
-            wildcard.metadata = None
+        def strip_metadata(subtree):
+            for i, child in enumerate(subtree.children):
+                if isinstance(child, Tree):
+                    strip_metadata(child)
+                    continue
+                elif not isinstance(child, ComplexWildCard):
+                    continue
+                # Wildcards are immutable, so swap in a copy without the metadata
+                stripped = child.replace(meta=None)
+                subtree.children[i] = stripped
+                if child.name == "void":
+                    # These are going to get removed, so key by index
+                    index = tree.children.index(child)
+                else:
+                    index = stripped
+                sentence_metadata[index] = child.metadata
 
+        strip_metadata(tree)
         tree = DiscardVoid().visit(tree)
         return tree, sentence_metadata
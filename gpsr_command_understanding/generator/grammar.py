@@ -1,6 +1,7 @@
-from copy import deepcopy
+import itertools
+import re
 
-from gpsr_command_understanding.util import replace_child, to_num
+from gpsr_command_understanding.util import to_num
 
 from gpsr_command_understanding.generator.tokens import NonTerminal, WildCard, ComplexWildCard
 
@@ -107,6 +108,14 @@ class DiscardVoid(Visitor):
     def expression(self, tree):
         tree.children = list(filter(lambda x: not (isinstance(x, WildCard) and x.name == "void"), tree.children))
 
+    # Rules that were loaded without expanding their shorthand still have their root marked
+    top_expression = expression
+
+    def choice(self, tree):
+        # An option that's only a void is the option to say nothing
+        tree.children = [Tree("expression", []) if isinstance(x, WildCard) and x.name == "void" else x
+                         for x in tree.children]
+
 
 class DiscardMeta(Visitor):
     """
@@ -114,9 +123,12 @@ class DiscardMeta(Visitor):
     """
 
     def expression(self, tree):
-        for child in tree.children:
-            if isinstance(child, ComplexWildCard):
-                child.metadata = None
+        for i, child in enumerate(tree.children):
+            if isinstance(child, ComplexWildCard) and child.metadata:
+                tree.children[i] = child.replace(meta=None)
+
+    top_expression = expression
+    choice = expression
 
 
 class RemovePrefix(Visitor):
@@ -192,52 +204,153 @@ class ToString(Transformer):
 tree_printer = ToString()
 
 
-class CombineExpressions(Visitor):
+class PrintTemplate(object):
     """
-    Grammars may generate multiple text fragments in a sequence. This will combine them
-    :param tokens:
-    :return: a list of tokens with no adjacent text fragments
+    A tree printed once, with holes where its wildcards go. Filling the holes gives the same text as grounding the
+    tree and printing it with tree_printer, without copying or walking the tree again
+    :param tree:
+    :param constants: fill holes the way logical forms take groundings, as string constants
+    """
+    _HOLE = re.compile("\0([0-9]+)\0")
+
+    def __init__(self, tree, constants=False):
+        self.constants = constants
+        self.wildcards = []
+        holes = {}
+
+        def punch(subtree):
+            children = []
+            for child in subtree.children:
+                if isinstance(child, Tree):
+                    child = punch(child)
+                elif isinstance(child, WildCard):
+                    hole = holes.get(child)
+                    if hole is None:
+                        hole = holes[child] = len(self.wildcards)
+                        self.wildcards.append(child)
+                    child = "\0{}\0".format(hole)
+                children.append(child)
+            return Tree(subtree.data, children)
+
+        pieces = self._HOLE.split(tree_printer(punch(tree)))
+        # Text before each hole, then whatever comes after the last one
+        self.text = pieces[0::2]
+        self.holes = [int(hole) for hole in pieces[1::2]]
+
+    def render(self, assignment):
+        """
+        :param assignment: dictionary from wildcard to its grounding. Wildcards that aren't in it are printed as is
+        :return: the printed tree
+        """
+        values = []
+        for wildcard in self.wildcards:
+            value = assignment.get(wildcard)
+            if value is None:
+                value = wildcard.to_human_readable()
+            elif self.constants:
+                value = "\" " + value.strip() + " \""
+            values.append(value)
+        text = self.text
+        out = [text[0]]
+        for i, hole in enumerate(self.holes, 1):
+            out.append(values[hole])
+            out.append(text[i])
+        return "".join(out)
+
+
+class SemanticsTemplate(object):
+    """
+    A logical form and the substitutions made into it so far. Substituting only records the replacement, so expanding a
+    pair doesn't copy its logical form; the tree is built once it's finished. It comes out the same as running
+    replace_child_in_tree on a copy for each substitution in turn: a substitution applies inside the replacements
+    made before it, but not inside its own
+    :param tree: the logical form. It's never modified
+    :param substitutions: tuple of (token, replacement) pairs, in the order they were made
     """
+    __slots__ = ("tree", "substitutions")
+
+    def __init__(self, tree, substitutions=()):
+        self.tree = tree
+        self.substitutions = substitutions
+
+    def substitute(self, target, replacement):
+        """
+        :param target: token to replace everywhere it appears
+        :param replacement: token or tree to put in its place
+        :return: a new SemanticsTemplate
+        """
+        return SemanticsTemplate(self.tree, self.substitutions + ((target, replacement),))
+
+    def to_tree(self):
+        """
+        :return: a new tree with the substitutions made. Only tokens are shared with the template and replacements
+        """
+        return self._build(self.tree, 0)
+
+    def _build(self, tree, start):
+        # start is the first substitution made after this tree was put in place
+        substitutions = self.substitutions
+        children = []
+        for child in tree.children:
+            made = start
+            while not isinstance(child, Tree):
+                for i in range(made, len(substitutions)):
+                    target, replacement = substitutions[i]
+                    if child == target:
+                        child, made = replacement, i + 1
+                        break
+                else:
+                    break
+            if isinstance(child, Tree):
+                child = self._build(child, made)
+            children.append(child)
+        return Tree(tree.data, children)
 
-    def top_expression(self, tree):
-        tree.data = "expression"
-        self.expression(tree)
+
+class NormalizeExpressions(Visitor):
+    """
+    DiscardVoid followed by CombineExpressions, in one pass. The visit is bottom up, so an expression's nested
+    expressions are already flat when it's reached, and its children are gathered into a new list once
+    :param discard_void: also drop void wildcards
+    """
+
+    def __init__(self, discard_void=True):
+        self.discard_void = discard_void
 
     def expression(self, tree):
+        discard_void = self.discard_void
         cleaned = []
-        i = 0
-        while i < len(tree.children):
-            child = tree.children[i]
-            # Not a fragment? Forward to output
-            if not (isinstance(child, Tree) and child.data == "expression"):
+        for child in tree.children:
+            if isinstance(child, Tree) and child.data == "expression":
+                cleaned.extend(child.children)
+            elif not (discard_void and isinstance(child, WildCard) and child.name == "void"):
                 cleaned.append(child)
-                i += 1
-                continue
-            # Otherwise, gather up the the next subsequence of fragments
-            j = i + 1
-            while j < len(tree.children):
-                next_child = tree.children[j]
-                if isinstance(next_child, Tree) and next_child.data == "expression":
-                    j += 1
-                    continue
-                break
-            cleaned.extend([c for t in tree.children[i:j] for c in t.children])
-            i = j
-        if i == len(tree.children) - 1:
-            cleaned.append(tree.children[i])
-
-        all_expanded = False
-        while not all_expanded:
-            i = 0
-            while i < len(cleaned):
-                child = cleaned[i]
-                if isinstance(child, Tree) and child.data == "expression":
-                    cleaned = cleaned[:i] + child.children + cleaned[i + 1:]
-                    break
-                i += 1
-            all_expanded = True
+        tree.data = "expression"
         tree.children = cleaned
 
+    top_expression = expression
+
+    def choice(self, tree):
+        if self.discard_void:
+            # An option that's only a void is the option to say nothing
+            tree.children = [Tree("expression", []) if isinstance(x, WildCard) and x.name == "void" else x
+                             for x in tree.children]
+
+
+class CombineExpressions(NormalizeExpressions):
+    """
+    Grammars may generate multiple text fragments in a sequence. This will combine them
+    :param tokens:
+    :return: a list of tokens with no adjacent text fragments
+    """
+
+    def __init__(self):
+        super().__init__(discard_void=False)
+
+
+normalize_expressions = NormalizeExpressions()
+combine_expressions = CombineExpressions()
+
 
 def expand_shorthand(tree):
     """
@@ -246,41 +359,50 @@ def expand_shorthand(tree):
     :param tree:
     :return:
     """
-    in_progress = [tree]
+    if not any(subtree.data == "choice" for subtree in tree.iter_subtrees()):
+        combine_expressions.visit(tree)
+        return [tree]
     output = []
-    combiner = CombineExpressions()
-    while len(in_progress) != 0:
-        current = in_progress.pop()
-        choice = None
-        # Find the unmade choice that's furthest up the tree
-        for subtree in current.iter_subtrees_topdown():
-            if subtree.data == "choice":
-                choice = subtree
-                break
-        if not choice:
-            # All choices expanded!
-            # Choices will make a mess of unnecessarily nested expressions. Clean
-            # up.
-            combiner.visit(current)
-            output.append(current)
-            continue
-        # Make the choice in every way
-        for option in choice.children:
-            choice_made_tree = deepcopy(current)
-            # Is this choice the root of the tree? No parent in this case
-            if choice_made_tree == choice:
-                in_progress.append(option)
-            else:
-                choice_parent = \
-                    list(choice_made_tree.find_pred(
-                        lambda subtree: any([child == choice for child in subtree.children])))[
-                        0]
-                replace_child(choice_parent, choice, option, only_once=True)
-                in_progress.append(choice_made_tree)
-
+    for expansion in _expansions(tree, {}):
+        # Expansions share subtrees, so give each its own before it's cleaned up in place
+        expansion = _copy_structure(expansion)
+        # Choices will make a mess of unnecessarily nested expressions. Clean
+        # up.
+        combine_expressions.visit(expansion)
+        output.append(expansion)
     return output
 
 
+def _expansions(tree, memo):
+    """
+    Every way of making the choices in a tree, each subtree's worked out once. The first choice (in top down order)
+    varies slowest, and options are taken last to first.
+    :param memo: dictionary from subtree id to its expansions
+    :return: list of trees, which may share subtrees with each other and with the input
+    """
+    expansions = memo.get(id(tree))
+    if expansions is not None:
+        return expansions
+    if tree.data == "choice":
+        expansions = []
+        for option in reversed(tree.children):
+            expansions.extend(_expansions(option, memo) if isinstance(option, Tree) else [option])
+    else:
+        child_expansions = [_expansions(child, memo) if isinstance(child, Tree) else [child] for child in tree.children]
+        if all(len(options) == 1 and options[0] is child for options, child in zip(child_expansions, tree.children)):
+            # No choices below here
+            expansions = [tree]
+        else:
+            expansions = [Tree(tree.data, list(children)) for children in itertools.product(*child_expansions)]
+    memo[id(tree)] = expansions
+    return expansions
+
+
+def _copy_structure(tree):
+    # Tokens are immutable. Only the tree nodes need copying
+    return Tree(tree.data, [_copy_structure(child) if isinstance(child, Tree) else child for child in tree.children])
+
+
 def rule_dict_to_str(rules):
     out = ""
     for non_term, productions in rules.items():
@@ -11,6 +11,107 @@ class KnowledgeBase:
     def __init__(self, items, attributes):
         self.by_name = items
         self.attributes = attributes
+        self.build_indexes()
+
+    def build_indexes(self):
+        """
+        Build the inverted indexes from (type, attribute, value) to items. Call again if attributes are changed
+        after construction
+        """
+        self._attribute_index = {}
+        for item_type, attributes_for_type in self.attributes.items():
+            for attribute_name, values in attributes_for_type.items():
+                index = {}
+                for item, value in values.items():
+                    index.setdefault(value, set()).add(item)
+                self._attribute_index[(item_type, attribute_name)] = {value: frozenset(items)
+                                                                      for value, items in index.items()}
+        # Intersections of the indexes, keyed by type and constraints
+        self._matches = {}
+        # What an obfuscated wildcard says instead of each item it could be grounded to
+        self._obfuscations = {}
+        for item_type in ("object", "location"):
+            table = {}
+            for item in self.by_name.get(item_type, []):
+                try:
+                    table[item] = self._obfuscation(item_type, item)
+                except KeyError:
+                    # Missing attributes only matter if the item is obfuscated, so leave the error for then
+                    continue
+            self._obfuscations[item_type] = table
+
+    def with_attributes(self, item_type, constraints):
+        """
+        :param item_type: e.g. "object"
+        :param constraints: sequence of (attribute, value) pairs
+        :return: frozenset of the items that have every one of the values. Items missing an attribute don't match
+        """
+        key = (item_type, tuple(constraints))
+        matches = self._matches.get(key)
+        if matches is not None:
+            return matches
+        matches = None
+        for attribute_name, value in constraints:
+            index = self._attribute_index.get((item_type, attribute_name))
+            if index is None:
+                raise RuntimeError(attribute_name + " is not a valid attribute for wildcard type " + item_type)
+            with_value = index.get(value, frozenset())
+            matches = with_value if matches is None else matches & with_value
+        if matches is None:
+            matches = frozenset(self.by_name[item_type])
+        self._matches[key] = matches
+        return matches
+
+    def obfuscate(self, item_type, grounding, wildcard_type=None):
+        """
+        :param item_type: name of the wildcard, e.g. "object"
+        :param grounding: the item the wildcard was grounded to
+        :param wildcard_type: type of the wildcard, e.g. "room"
+        :return: what an obfuscated wildcard says instead of the grounding. The object's singular category, or the
+            room a location is in
+        """
+        if item_type == "category":
+            return "objects"
+        elif item_type == "location" and wildcard_type == "room":
+            return "room"
+        table = self._obfuscations.get(item_type)
+        if table is None:
+            return None
+        obfuscation = table.get(grounding)
+        if obfuscation is None:
+            # Something that isn't in by_name. Look it up the long way
+            obfuscation = self._obfuscation(item_type, grounding)
+        return obfuscation
+
+    def obfuscate_all(self, item_type, groundings, wildcard_type=None):
+        """
+        Obfuscate a column of groundings of the same kind of wildcard at once
+        :param item_type: see obfuscate
+        :param groundings: list of items
+        :param wildcard_type: see obfuscate
+        :return: list of what an obfuscated wildcard says instead of each grounding
+        """
+        if item_type == "category":
+            return ["objects"] * len(groundings)
+        elif item_type == "location" and wildcard_type == "room":
+            return ["room"] * len(groundings)
+        table = self._obfuscations.get(item_type)
+        if table is None:
+            return [None] * len(groundings)
+        try:
+            return [table[grounding] for grounding in groundings]
+        except KeyError:
+            # Something that isn't in by_name. Look it up the long way
+            return [table[grounding] if grounding in table else self._obfuscation(item_type, grounding)
+                    for grounding in groundings]
+
+    def _obfuscation(self, item_type, item):
+        if item_type == "object":
+            # What's the category of this object?
+            category = self.attributes["object"]["category"][item]
+            return self.attributes["category"]["singular"][category]
+        # What room is this beacon or placement in?
+        return self.attributes["location"]["in"][item]
 
     @staticmethod
     def from_dir(xml_path):
@@ -62,7 +163,7 @@ class KnowledgeBase:
         return KnowledgeBase(by_name, attributes)
 
 
-class AnonymizedKnowledgebase:
+class AnonymizedKnowledgebase(KnowledgeBase):
     def __init__(self):
         names = [
             "object",
@@ -85,3 +186,4 @@ class AnonymizedKnowledgebase:
                            "category": {"singular": {x:  x for x in self.by_name["category"]}}}
         for room in rooms:
             self.attributes["location"]["isroom"][room] = True
+        self.build_indexes()
@@ -1,5 +1,6 @@
 import importlib_resources
 
+from gpsr_command_understanding.generator import rule_cache
 from gpsr_command_understanding.generator.generator import Generator
 from gpsr_command_understanding.generator.knowledge import KnowledgeBase
 from gpsr_command_understanding.generator.paired_generator import PairedGenerator
@@ -10,80 +11,108 @@ GRAMMAR_DIR_2021 = "gpsr_command_understanding.resources.generator2021"
 
 GRAMMAR_YEAR_TO_MODULE = {2018: GRAMMAR_DIR_2018, 2019: GRAMMAR_DIR_2019, 2021: GRAMMAR_DIR_2021}
 
-def load_2018_by_cat(grammar_dir):
+
+def read_lines(grammar_dir, name):
+    with importlib_resources.open_text(grammar_dir, name) as resource_file:
+        return resource_file.readlines()
+
+
+def load_rules_cached(generator, grammar_files, expand_shorthand=True, use_cache=True):
+    """
+    Same as generator.load_rules, but the loaded rules are cached on disk (see rule_cache) and reused for as long
+    as the files' content doesn't change
+    :param grammar_files: list of files, each a list of lines
+    """
+    key = rule_cache.cache_key("rules", (generator._grammar_format_version, expand_shorthand), grammar_files)
+    loaded = rule_cache.load_cached(key) if use_cache else None
+    if loaded is None:
+        existing = generator.rules
+        generator.rules = {}
+        generator.load_rules(grammar_files, expand_shorthand=expand_shorthand)
+        loaded = dict(generator.rules)
+        generator.rules = existing
+        if use_cache:
+            rule_cache.store_cached(key, loaded)
+    # Merge the same way load_rules would have
+    for symbol, productions in loaded.items():
+        generator.rules.setdefault(symbol, []).extend(productions)
+    generator.rules.changed(loaded.keys())
+
+
+def load_semantics_cached(generator, semantics_files, use_cache=True):
+    """
+    Same as generator.load_semantics_rules, with the result cached like load_rules_cached
+    :param semantics_files: list of files, each a list of lines
+    """
+    key = rule_cache.cache_key("semantics", generator.semantic_form_version, semantics_files)
+    loaded = rule_cache.load_cached(key) if use_cache else None
+    if loaded is None:
+        existing = generator.semantics
+        generator.semantics = {}
+        generator.load_semantics_rules(semantics_files)
+        loaded = generator.semantics
+        generator.semantics = existing
+        if use_cache:
+            rule_cache.store_cached(key, loaded)
+    generator.semantics.update(loaded)
+    generator.semantics_changed(loaded.keys())
+
+
+def load_2018_by_cat(grammar_dir, use_cache=True):
     kb = KnowledgeBase.from_dir(grammar_dir)
-    with importlib_resources.open_text(grammar_dir, "common_rules.txt") as common_file:
-        common = common_file.readlines()
+    common = read_lines(grammar_dir, "common_rules.txt")
 
     cat1_gen = Generator(kb, grammar_format_version=2018)
     cat2_gen = Generator(kb, grammar_format_version=2018)
     cat3_gen = Generator(kb, grammar_format_version=2018)
-    with importlib_resources.open_text(grammar_dir, "gpsr_category_1_grammar.txt") as cat1:
-        cat1_gen.load_rules([common, cat1])
-    with importlib_resources.open_text(grammar_dir, "gpsr_category_2_grammar.txt") as cat2:
-        cat2_gen.load_rules([common, cat2])
-    with importlib_resources.open_text(grammar_dir, "gpsr_category_3_grammar.txt") as cat3:
-        cat3_gen.load_rules([common, cat3])
+    load_rules_cached(cat1_gen, [common, read_lines(grammar_dir, "gpsr_category_1_grammar.txt")], use_cache=use_cache)
+    load_rules_cached(cat2_gen, [common, read_lines(grammar_dir, "gpsr_category_2_grammar.txt")], use_cache=use_cache)
+    load_rules_cached(cat3_gen, [common, read_lines(grammar_dir, "gpsr_category_3_grammar.txt")], use_cache=use_cache)
 
     return [cat1_gen, cat2_gen, cat3_gen]
 
 
-def load_paired_2018_by_cat(grammar_dir):
-    cat1_gen, cat2_gen, cat3_gen = map(PairedGenerator.from_generator, load_2018_by_cat(grammar_dir))
+def load_paired_2018_by_cat(grammar_dir, use_cache=True):
+    cat1_gen, cat2_gen, cat3_gen = map(PairedGenerator.from_generator, load_2018_by_cat(grammar_dir, use_cache=use_cache))
 
-    with importlib_resources.open_text(grammar_dir, "gpsr_category_1_semantics.txt") as cat1:
-        cat1_gen.load_semantics_rules(cat1)
-    with importlib_resources.open_text(grammar_dir,
-                                       "gpsr_category_1_semantics.txt") as cat1, importlib_resources.open_text(
-            grammar_dir, "gpsr_category_2_semantics.txt") as cat2:
-        cat2_gen.load_semantics_rules([cat1, cat2])
-    with importlib_resources.open_text(grammar_dir, "gpsr_category_3_semantics.txt") as cat3:
-        cat3_gen.load_semantics_rules([cat3])
+    cat1 = read_lines(grammar_dir, "gpsr_category_1_semantics.txt")
+    load_semantics_cached(cat1_gen, [cat1], use_cache=use_cache)
+    load_semantics_cached(cat2_gen, [cat1, read_lines(grammar_dir, "gpsr_category_2_semantics.txt")], use_cache=use_cache)
+    load_semantics_cached(cat3_gen, [read_lines(grammar_dir, "gpsr_category_3_semantics.txt")], use_cache=use_cache)
 
     return [cat1_gen, cat2_gen, cat3_gen]
 
 
-def load_2018(grammar_dir):
+def load_2018(grammar_dir, expand_shorthand=True, use_cache=True):
     kb = KnowledgeBase.from_dir(grammar_dir)
     generator = Generator(kb, grammar_format_version=2018)
 
-    common_path = importlib_resources.open_text(grammar_dir, "common_rules.txt")
-    grammar_files = [common_path, importlib_resources.open_text(grammar_dir, "gpsr_category_1_grammar.txt"),
-                     importlib_resources.open_text(grammar_dir, "gpsr_category_2_grammar.txt"),
-                     importlib_resources.open_text(grammar_dir, "gpsr_category_3_grammar.txt")]
-    generator.load_rules(grammar_files)
-
-    for file in grammar_files:
-        file.close()
+    grammar_files = [read_lines(grammar_dir, name) for name in
+                     ["common_rules.txt", "gpsr_category_1_grammar.txt", "gpsr_category_2_grammar.txt",
+                      "gpsr_category_3_grammar.txt"]]
+    load_rules_cached(generator, grammar_files, expand_shorthand=expand_shorthand, use_cache=use_cache)
     return generator
 
 
-def load_paired_2018(grammar_dir):
-    generator = load_2018(grammar_dir)
+def load_paired_2018(grammar_dir, expand_shorthand=True, use_cache=True):
+    generator = load_2018(grammar_dir, expand_shorthand=expand_shorthand, use_cache=use_cache)
     generator = PairedGenerator.from_generator(generator)
-    semantics = [importlib_resources.open_text(grammar_dir, "gpsr_category_1_semantics.txt"),
-                 importlib_resources.open_text(grammar_dir, "gpsr_category_2_semantics.txt"),
-                 importlib_resources.open_text(grammar_dir, "gpsr_category_3_semantics.txt")]
-    generator.load_semantics_rules(semantics)
-    for file in semantics:
-        file.close()
+    semantics = [read_lines(grammar_dir, name) for name in
+                 ["gpsr_category_1_semantics.txt", "gpsr_category_2_semantics.txt", "gpsr_category_3_semantics.txt"]]
+    load_semantics_cached(generator, semantics, use_cache=use_cache)
     return generator
 
 
-def load(generator, task, grammar_dir, expand_shorthand=True):
+def load(generator, task, grammar_dir, expand_shorthand=True, use_cache=True):
     generator.knowledge_base = KnowledgeBase.from_dir(grammar_dir)
-    with importlib_resources.open_text(grammar_dir, task + ".txt") as task_rules_file:
-        task_rules = task_rules_file.readlines()
+    task_rules = read_lines(grammar_dir, task + ".txt")
     # Only load common rules if they're imported in this task's grammar
     if any(map(lambda rule: "common.txt" in rule, task_rules)):
-        with importlib_resources.open_text(grammar_dir, "common_rules.txt") as common_rules_file:
-            task_rules += common_rules_file.readlines()
-    generator.load_rules([task_rules],
-                         expand_shorthand=expand_shorthand)
+        task_rules += read_lines(grammar_dir, "common_rules.txt")
+    load_rules_cached(generator, [task_rules], expand_shorthand=expand_shorthand, use_cache=use_cache)
 
 
-def load_paired(generator, task, grammar_dir, expand_shorthand=True):
-    load(generator, task, grammar_dir, expand_shorthand=expand_shorthand)
+def load_paired(generator, task, grammar_dir, expand_shorthand=True, use_cache=True):
+    load(generator, task, grammar_dir, expand_shorthand=expand_shorthand, use_cache=use_cache)
     generator = PairedGenerator.from_generator(generator)
-    with importlib_resources.open_text(grammar_dir, task + "_semantics.txt") as semantics:
-        generator.load_semantics_rules(semantics)
+    load_semantics_cached(generator, [read_lines(grammar_dir, task + "_semantics.txt")], use_cache=use_cache)
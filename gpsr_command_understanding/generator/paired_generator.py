@@ -1,45 +1,28 @@
 import copy
-import sys
-from itertools import zip_longest
+from collections import deque
+from itertools import chain, zip_longest
 
-import importlib_resources
-from lark import Lark, exceptions, Tree, Token
+from lark import exceptions, Tree, Token
 
+from gpsr_command_understanding.generator import rule_cache
+from gpsr_command_understanding.generator.derivation import flatten_expression
 from gpsr_command_understanding.generator.generator import Generator
+from gpsr_command_understanding.generator.parallel import expand_all_semantics_parallel
+from gpsr_command_understanding.generator.parser_registry import SEMANTIC_FORMS, semantics_parser
 from gpsr_command_understanding.generator.grammar import RemovePrefix, TypeConverter, CompactUnderscorePrefixed, \
-    tree_printer, expand_shorthand, DiscardVoid, CombineExpressions, NonTerminal
+    tree_printer, expand_shorthand, normalize_expressions, DiscardMeta, NonTerminal, PrintTemplate, SemanticsTemplate
 from gpsr_command_understanding.generator.tokens import ROOT_SYMBOL, WildCard
-from gpsr_command_understanding.util import get_wildcards_forest, get_placeholders, has_nonterminals, \
-    replace_child_in_tree
-
-try:
-    from queue import Queue as queue
-except ImportError:
-    from Queue import queue
-
-SEMANTIC_FORMS = {"lambda": importlib_resources.read_text("gpsr_command_understanding.resources", "lambda_ebnf.lark")}
+from gpsr_command_understanding.generator.tree_columns import TreeColumns
+from gpsr_command_understanding.util import get_wildcards_forest, get_placeholders, has_nonterminals
 
 
 class LambdaParserWrapper:
     def __init__(self, grammar_spec=SEMANTIC_FORMS["lambda"]):
-        # FIXME: Ensure that the import statement will work in different contexts
-        # This grammar uses an import statement, which will trigger a local search for the imported file.
-        # We aren't guaranteed that resources live as files (could be zipped up), so this will
-        # probably break for distribution.
-        with importlib_resources.path("gpsr_command_understanding.resources", "generator.lark") as path:
-            # When a grammar comes in as a string, lark will check where the main script is located
-            # to start its search. We'll manually point it to a path that importlib tells us has
-            # the imported grammar.
-            old_main = sys.modules['__main__'].__file__
-            sys.modules['__main__'].__file__ = path
-            self.parser = Lark(grammar_spec,
-                               start='start', parser="lalr")
-            # Because the imported rules come into a namespace, we'll have to run our own clean up, but then
-            # it's as though we cut and pasted the imported rules
-            self.post_process = RemovePrefix("generator__")
-            self.compact = TypeConverter() * CompactUnderscorePrefixed()
-            # Clean up
-            sys.modules['__main__'].__file__ = old_main
+        self.parser = semantics_parser(grammar_spec)
+        # Because the imported rules come into a namespace, we'll have to run our own clean up, but then
+        # it's as though we cut and pasted the imported rules
+        self.post_process = RemovePrefix("generator__")
+        self.compact = TypeConverter() * CompactUnderscorePrefixed()
 
     def parse(self, to_parse):
         parsed = self.parser.parse(to_parse)
@@ -54,6 +37,43 @@ class PairedGenerator(Generator):
         self.lambda_parser = LambdaParserWrapper()
         self.semantic_form_version = semantic_form_version
         self.semantics = {}
+        # Parsed semantics lines from the last reload_semantics_rules
+        self._semantics_lines = {}
+
+    @property
+    def semantics(self):
+        return self._semantics
+
+    @semantics.setter
+    def semantics(self, semantics):
+        self._semantics = semantics
+        self._semantics_index = None
+
+    def semantics_changed(self, utterances):
+        """
+        Call after editing semantics in place, so that lookups and anything derived from the edited rules see the change
+        :param utterances: keys of the semantics rules that were added, changed or removed
+        """
+        self._semantics_index = None
+        self.artifacts.invalidate(utterances)
+
+    def _indexed_semantics(self):
+        """
+        :return: dictionary from the compiled grammar's canonical key of each semantics rule's utterance to a
+            SemanticsTemplate of its semantics
+        """
+        compiled = self.compiled
+        if self._semantics_index is None or self._semantics_index[0] is not compiled:
+            index = {}
+            for utterance, semantics in self._semantics.items():
+                # generate only ever looks up flat expressions
+                if not isinstance(utterance, Tree) or utterance.data != "expression" or any(
+                        isinstance(child, Tree) for child in utterance.children):
+                    continue
+                index[compiled.canonical_key([compiled.intern(token) for token in utterance.children])] = SemanticsTemplate(
+                    semantics)
+            self._semantics_index = (compiled, index)
+        return self._semantics_index[1]
 
     @staticmethod
     def from_generator(plain_generator, **kwargs):
@@ -112,15 +132,65 @@ class PairedGenerator(Generator):
         if not isinstance(semantics_files, list):
             semantics_files = [semantics_files]
         i = 0
+        loaded = {}
         for semantics_file in semantics_files:
             for line in semantics_file:
                 cleaned = line.strip()
-                i += self.__parse_rule(cleaned, self.semantics)
+                i += self.__parse_rule(cleaned, loaded)
+        self.semantics.update(loaded)
+        self.semantics_changed(loaded.keys())
 
         return i
 
+    def reload_semantics_rules(self, semantics_files):
+        """
+        Make the semantics exactly what semantics_files define, changing only the entries that differ. Like
+        reload_rules, unchanged lines aren't parsed again and only artifacts that depend on a changed entry are dropped
+        :param semantics_files: list of files
+        :return: set of utterances whose semantics were added, removed or changed
+        """
+        if not isinstance(semantics_files, list):
+            semantics_files = [semantics_files]
+
+        semantics = {}
+        lines = {}
+        for semantics_file in semantics_files:
+            for line in semantics_file:
+                cleaned = line.strip()
+                parsed = self._semantics_lines.get(cleaned)
+                if parsed is None:
+                    loaded = {}
+                    self.__parse_rule(cleaned, loaded)
+                    parsed = list(loaded.items())
+                lines[cleaned] = parsed
+                semantics.update(parsed)
+        self._semantics_lines = lines
+
+        # See reload_rules
+        changed = {utterance for utterance in self.semantics.keys() | semantics.keys()
+                   if rule_cache.describe(self.semantics.get(utterance)) != rule_cache.describe(semantics.get(utterance))}
+        for utterance in changed:
+            if utterance in semantics:
+                self.semantics[utterance] = semantics[utterance]
+            else:
+                del self.semantics[utterance]
+        self.semantics_changed(changed)
+        return changed
+
+    def expand_semantics(self, utterance):
+        """
+        All the pairs generate makes from one semantics rule. They're kept in artifacts until the rule, or a rule its
+        utterance can derive through, is reloaded
+        :param utterance: key of the semantics rule (a tree, or a single token)
+        :return: list of (utterance, semantics) pairs
+        """
+        roots = [utterance]
+        if isinstance(utterance, Tree):
+            roots.extend(utterance.scan_values(lambda token: isinstance(token, NonTerminal)))
+        return self.derived(("semantics pairs", utterance), roots, lambda: list(self.generate(utterance, False)))
+
     def generate(self, start_pair, yield_requires_semantics=True,  # noqa: C901
-                 branch_cap=None, random_generator=None):
+                 branch_cap=None, random_generator=None, max_frontier=None, stats=None):
         """
         Expand the start_symbols in breadth first order. At each expansion, see if we have an associated semantic template.
         If the current expansion has a semantics associated, also apply the expansion to the semantics.
@@ -130,6 +200,10 @@ class PairedGenerator(Generator):
         :param branch_cap: if there are too many expansions, set a fixed cap which will be applied
         :param random_generator: random number generator used to determine expansions, shuffling
         :param yield_requires_semantics: if true, will yield sentences that don't have associated semantics. Helpful for debugging.
+        :param max_frontier: while more partial pairs than this are waiting, expand the newest ones first (depth first),
+            which keeps the frontier near the cap plus one level of expansions per step of depth. 0 is plain depth
+            first. The same pairs come out, in a different order
+        :param stats: optional dictionary. "peak_frontier" is set to the most partial pairs that were waiting at once
         """
 
         # Make sure the start point is a Tree
@@ -141,22 +215,33 @@ class PairedGenerator(Generator):
             start_pair = (start_pair, None)
         else:
             assert isinstance(start_pair, tuple) and isinstance(start_pair[0], Tree)
-
-        frontier = queue()
-        frontier.put(start_pair)
-        while not frontier.empty():
-            sentence, semantics = frontier.get()
+        start_sentence, start_semantics = start_pair
+        if start_semantics:
+            start_semantics = SemanticsTemplate(start_semantics)
+        compiled = self.compiled
+        start_sentence = compiled.compile_tokens(flatten_expression(start_sentence), discard_void=True)
+
+        semantics_index = self._indexed_semantics()
+        shuffled_orders = {}
+        # Each partial pair carries its sentence's canonical key until it picks up semantics, so a lookup doesn't
+        # have to rebuild the key (or a tree) from the whole sentence
+        frontier = deque([(start_sentence, start_semantics, compiled.canonical_key(start_sentence.tokens))])
+        peak = 1
+        if stats is not None:
+            stats["peak_frontier"] = peak
+        while frontier:
+            depth_first = max_frontier is not None and len(frontier) > max_frontier
+            sentence, semantics, key = frontier.pop() if depth_first else frontier.popleft()
             if not semantics:
                 # Let's see if the  expansion is associated with any semantics
-                semantics = self.semantics.get(sentence)
-            expansions = list(self.expand_pair(sentence, semantics, branch_cap=branch_cap,
-                                               random_generator=random_generator))
-            if not expansions:
+                semantics = semantics_index.get(key)
+            if not sentence.frontier:
+                sentence = compiled.to_tree(sentence)
                 assert not has_nonterminals(sentence)
                 # If we couldn't replace anything else, this sentence is done!
                 if semantics:
-                    DiscardVoid().visit(semantics)
-                    CombineExpressions().visit(semantics)
+                    semantics = semantics.to_tree()
+                    normalize_expressions.visit(semantics)
                     sem_placeholders_remaining = get_placeholders(semantics)
                     sentence_placeholders_remaining = get_placeholders(sentence)
                     # If we have unexpanded non-terminals, something is wrong with the rules
@@ -192,8 +277,16 @@ class PairedGenerator(Generator):
                     continue
                 yield sentence, semantics
                 continue
-            for pair in expansions:
-                frontier.put(pair)
+            expansions = self._expand_indexed(sentence, semantics, key, branch_cap, random_generator, shuffled_orders)
+            if depth_first:
+                # The first expansion should be the next one out
+                frontier.extend(reversed(list(expansions)))
+            else:
+                frontier.extend(expansions)
+            if len(frontier) > peak:
+                peak = len(frontier)
+                if stats is not None:
+                    stats["peak_frontier"] = peak
 
             # What productions don't have semantics?
             """if not modified_semantics:
@@ -204,46 +297,88 @@ class PairedGenerator(Generator):
         return self.generate(sentence, {}, start_semantics=semantics,
                              branch_cap=branch_cap, random_generator=random_generator)
 
-    def expand_pair(self, sentence, semantics, branch_cap=None, random_generator=None):
-        replace_tokens = list(sentence.scan_values(lambda x: x in self.rules.keys()))
-
-        if not replace_tokens:
+    def expand_pair(self, sentence, semantics, branch_cap=None, random_generator=None, shuffled_orders=None):
+        """
+        Apply every production of one open symbol in the sentence, and apply the same substitution to the semantics.
+        :param sentence: an IndexedSentence of compiled symbol IDs, or an expression Tree
+        :param shuffled_orders: dictionary that keeps the shuffled production order for each symbol between calls, so
+                                uncapped random expansion reshuffles the previous order instead of starting fresh
+        :return: generator of (sentence, semantics) pairs. Sentences come back in the type they were passed in
+        """
+        compiled = self.compiled
+        as_tree = isinstance(sentence, Tree)
+        if as_tree:
+            sentence = compiled.compile_tokens(flatten_expression(sentence), discard_void=True)
+        if semantics:
+            semantics = SemanticsTemplate(semantics)
+        expansions = self._expand_indexed(sentence, semantics, None, branch_cap, random_generator, shuffled_orders)
+        for sentence_filled, modified_semantics, _ in expansions:
+            yield (compiled.to_tree(sentence_filled) if as_tree else sentence_filled,
+                   modified_semantics.to_tree() if modified_semantics else None)
+
+    def _expand_indexed(self, sentence, semantics, key, branch_cap, random_generator, shuffled_orders):  # noqa: C901
+        """
+        expand_pair for IndexedSentences, with semantics as a SemanticsTemplate. If semantics is empty and key is the
+        sentence's canonical key, each expansion comes with its own key; otherwise with None
+        :return: generator of (sentence, semantics, key) tuples
+        """
+        compiled = self.compiled
+        if not sentence.frontier:
             return
 
         if random_generator:
-            replace_token = random_generator.choice(replace_tokens)
-            productions = self.rules[replace_token]
+            which = random_generator.randrange(len(sentence.frontier))
+            replace_id = sentence.tokens[sentence.frontier[which]]
+            # Substitutions always land on the first occurrence of the chosen symbol
+            which = next(i for i, position in enumerate(sentence.frontier) if sentence.tokens[position] == replace_id)
+            choices = range(len(compiled.resolved_productions(replace_id)))
             if branch_cap:
-                productions = random_generator.sample(productions, k=min(branch_cap, len(productions)))
+                choices = random_generator.sample(choices, k=min(branch_cap, len(choices)))
             else:
                 # Use all of the branches
-                productions = self.rules[replace_token]
-                random_generator.shuffle(productions)
+                if shuffled_orders is None:
+                    shuffled_orders = {}
+                choices = shuffled_orders.setdefault(replace_id, list(choices))
+                random_generator.shuffle(choices)
         else:
             # We know we have at least one, so we'll just use the first
-            replace_token = replace_tokens[0]
-            productions = self.rules[replace_token]
+            which = 0
+            replace_id = sentence.tokens[sentence.frontier[0]]
+            choices = range(len(compiled.resolved_productions(replace_id)))
             if branch_cap:
-                productions = productions[:min(branch_cap, len(productions))]
-
-        for production in productions:
-            modified_sentence = copy.deepcopy(sentence)
-            replace_child_in_tree(modified_sentence, replace_token, production, only_once=True)
-            modified_sentence = DiscardVoid().visit(modified_sentence)
-
-            # Normalize any chopped up text fragments to make sure we can pull semantics for these cases
-            sentence_filled = CombineExpressions().visit(modified_sentence)
+                choices = choices[:min(branch_cap, len(choices))]
+
+        # Void wildcards are already gone from the indexed productions, and the result is flat, so it's
+        # normalized to match the semantics keys. Inline choices (if the rules weren't expanded when they were loaded)
+        # are made here too, otherwise the semantics keys would never match
+        indexed_productions = compiled.resolved_productions(replace_id, discard_void=True)
+        replace_token = compiled.symbols[replace_id]
+        productions = self.rules[replace_token]
+        if semantics or key is None:
+            # Once there are semantics, nothing looks the sentence up again
+            key = None
+        else:
+            position = sentence.frontier[which]
+            before, after = key[:position], key[position + 1:]
+            production_keys = compiled.canonical_productions(replace_id)
+        for choice in choices:
+            _, indexed_production = indexed_productions[choice]
+            sentence_filled = sentence.substitute(which, indexed_production)
             # If we've got semantics for this expansion already, see if the replacements apply to them
             # For the basic annotation we provided, this should only happen when expanding ground terms
 
             modified_semantics = None
             if semantics:
-                modified_semantics = copy.deepcopy(semantics)
                 # NOTE: Produce needs to be a properly specified tree for the semantics to come out properly
                 # Especially important if the rule expands to string. This needs to be a single
                 # Token("ESCAPED_STRING",...)
-                replace_child_in_tree(modified_semantics, replace_token, production)
-            yield sentence_filled, modified_semantics
+                rule_index, production = compiled.resolved_productions(replace_id)[choice]
+                if production is compiled.productions[replace_id][rule_index]:
+                    production = productions[rule_index]
+                else:
+                    production = compiled.to_tree(production)
+                modified_semantics = semantics.substitute(replace_token, production)
+            yield sentence_filled, modified_semantics, None if key is None else before + production_keys[choice] + after
 
     def expand_all_semantics(self):
         """
@@ -252,20 +387,29 @@ class PairedGenerator(Generator):
         for utterance, parse in self.semantics.items():
             yield from self.generate(utterance, False)
 
-    def generate_groundings(self, pair, random_generator=None, ignore_types=False):
+    def generate_groundings(self, pair, random_generator=None, ignore_types=False, count=None):
         utt, logical = pair
-        assignments = self.generate_grounding_assignments(utt, random_generator=random_generator,
-                                                          ignore_types=ignore_types)
-        for assignment in assignments:
-            grounded_utt = copy.deepcopy(utt)
-            grounded_logical = copy.deepcopy(logical)
-            for token, replacement in assignment.items():
-                replace_child_in_tree(grounded_utt, token, replacement)
-                # We may not have had semantics
-                if grounded_logical:
-                    replace_child_in_tree(grounded_logical, token, Token("ESCAPED_STRING", "\"" + replacement + "\""))
+        for assignment in self._assignments(utt, random_generator, ignore_types, count):
+            grounded_utt = SemanticsTemplate(utt, tuple(assignment.items())).to_tree()
+            grounded_logical = None
+            # We may not have had semantics
+            if logical:
+                grounded_logical = SemanticsTemplate(logical, tuple(
+                    (token, Token("ESCAPED_STRING", "\"" + replacement + "\"")) for token, replacement in assignment.items())).to_tree()
             yield grounded_utt, grounded_logical
 
+    def generate_grounded_text(self, pair, random_generator=None, ignore_types=False, count=None):
+        """
+        Like generate_groundings, but yields the printed (utterance, logical form) strings. Each side is printed once
+        with holes for its wildcards, so a grounding is only a join
+        """
+        utt, logical = pair
+        utt_template = PrintTemplate(utt)
+        # We may not have had semantics
+        logical_template = PrintTemplate(logical, constants=True) if logical else None
+        for assignment in self._assignments(utt, random_generator, ignore_types, count):
+            yield utt_template.render(assignment), logical_template.render(assignment) if logical_template else None
+
     def _print_semantics_rules(self):
         for key, expansion in self.semantics.items():
             print(tree_printer(key))
@@ -273,11 +417,35 @@ class PairedGenerator(Generator):
             print("----------------")
 
 
-def pairs_without_placeholders(generator, only_in_grammar=False):
-    pairs = generator.expand_all_semantics()
+def pairs_without_placeholders(generator, only_in_grammar=False, processes=None, incremental=False,
+                               use_cache=True):
+    """
+    :param processes: if set, expand the semantics rules with a pool of this many processes. The result is the same
+    :param incremental: take each semantics rule's pairs from generator.expand_semantics, so that after a reload only
+        the rules it affected are expanded again. The result is the same
+    :param use_cache: keep the result on disk as TreeColumns (see rule_cache), keyed by the content of the rules and
+        semantics, and reuse it for as long as neither changes. The grammar's sentences are kept the same way
+    """
+    key = None
+    if use_cache and rule_cache.cache_dir():
+        key = rule_cache.cache_key("pairs", (generator._grammar_format_version, generator.semantic_form_version,
+                                             only_in_grammar),
+                                   [rule_cache.content_lines(generator.rules), rule_cache.content_lines(generator.semantics)])
+        cached = rule_cache.load_columns(key)
+        if cached is not None:
+            # Utterances and logical forms alternate
+            columns = iter(cached)
+            return dict(zip(columns, columns))
+    if incremental:
+        pairs = chain.from_iterable(map(generator.expand_semantics, list(generator.semantics.keys())))
+    elif processes:
+        pairs = expand_all_semantics_parallel(generator, processes=processes)
+    else:
+        pairs = generator.expand_all_semantics()
     out = {}
     if only_in_grammar:
-        all_utterances_in_grammar = set(generator.generate(ROOT_SYMBOL, generator))
+        meta_remover = DiscardMeta()
+        all_utterances_in_grammar = _grammar_sentences(generator, use_cache)
     for command, parse in pairs:
         if has_nonterminals(command) or has_nonterminals(parse):
             # This case is almost certainly a bug with the annotations
@@ -285,7 +453,34 @@ def pairs_without_placeholders(generator, only_in_grammar=False):
                 command))
             continue
         # If it's important that we only get pairs that are in the grammar, check to make sure
-        if only_in_grammar and command not in all_utterances_in_grammar:
+        if only_in_grammar and meta_remover.visit(copy.deepcopy(command)) not in all_utterances_in_grammar:
             continue
         out[command] = parse
+    if key is not None:
+        rule_cache.store_columns(key, TreeColumns.from_trees(chain.from_iterable(out.items())))
     return out
+
+
+def _grammar_sentences(generator, use_cache):
+    """
+    :return: TreeColumns of every sentence the grammar derives, without voids or wildcard metadata. Generated pairs have
+        no voids, and wildcards hash their metadata (though they don't compare it), so it's dropped from both sides. The
+        sentences are kept with the rules, and on disk if use_cache is set, so later checks don't enumerate the grammar
+        again
+    """
+    def build():
+        key = None
+        if use_cache and rule_cache.cache_dir():
+            key = rule_cache.cache_key("sentences", (generator._grammar_format_version, str(ROOT_SYMBOL)),
+                                       [rule_cache.content_lines(generator.rules)])
+            cached = rule_cache.load_columns(key)
+            if cached is not None:
+                return cached
+        meta_remover = DiscardMeta()
+        sentences = TreeColumns.from_trees((meta_remover.visit(normalize_expressions.visit(sentence))
+                                            for sentence in generator.enumerate(ROOT_SYMBOL)), unique=True)
+        if key is not None:
+            rule_cache.store_columns(key, sentences)
+        return sentences
+
+    return generator.derived(("sentences without void or meta", ROOT_SYMBOL), [ROOT_SYMBOL], build)
@@ -0,0 +1,173 @@
+import multiprocessing
+
+from lark import Tree
+
+from gpsr_command_understanding.util import has_nonterminals
+
+# Each worker process gets its own copy of whatever it needs once, through the pool initializer
+_worker_compiled = None
+_worker_results = None
+_worker_generator = None
+
+
+def partition_derivations(generator, start_tree, split_depth, branch_cap=None):
+    """
+    Expand the first few leftmost symbols of the start tree, the same way enumerate would.
+    Enumerating each partition in turn and concatenating the results gives exactly the serial enumeration order.
+    :param generator: Generator with the rules loaded
+    :param start_tree: the list of tokens to begin expanding
+    :param split_depth: how many expansions deep to split. 1 gives one partition per production of the start symbol
+    :param branch_cap: limit on the number of different branches to pursue
+    :return: list of Derivations
+    """
+    compiled = generator.compiled
+
+    def split(derivation, depth):
+        if depth == 0 or derivation.next_symbol is None:
+            return [derivation]
+        productions = compiled.productions[derivation.next_symbol]
+        if branch_cap:
+            productions = productions[:min(branch_cap, len(productions))]
+        children = [derivation.expand(production.tokens, compiled.open_ids) for production in productions]
+        partitions = []
+        # enumerate works off a stack, so the last production is finished first
+        for child in reversed(children):
+            partitions.extend(split(child, depth - 1))
+        return partitions
+
+    return split(generator.start_derivation(start_tree), split_depth)
+
+
+def _init_enumeration_worker(compiled, results):
+    global _worker_compiled, _worker_results
+    _worker_compiled = compiled
+    _worker_results = results
+
+
+def _enumerate_partition(args):
+    """
+    Sends the partition's sentences back through the results queue as (partition index, chunk index, sentences, last)
+    messages, so neither side holds the whole partition at once. An error is sent in place of the sentences
+    """
+    partition_index, derivation, branch_cap, unique, chunk_size = args
+    chunk_index = 0
+    try:
+        sentences = []
+        seen = set()
+        for ids in _worker_compiled.derive([derivation], branch_cap=branch_cap):
+            ids = tuple(ids)
+            if unique:
+                if ids in seen:
+                    continue
+                seen.add(ids)
+            sentences.append(ids)
+            if len(sentences) == chunk_size:
+                _worker_results.put((partition_index, chunk_index, sentences, False))
+                chunk_index += 1
+                sentences = []
+        _worker_results.put((partition_index, chunk_index, sentences, True))
+    except Exception as e:
+        _worker_results.put((partition_index, chunk_index, e, True))
+
+
+def _partition_chunks(pool, results, tasks, window, deterministic):
+    """
+    Hand tasks to the pool a window at a time and yield the chunks of sentences they send back
+    :param window: most partitions that are started but not yet yielded in full
+    """
+    submitted = 0
+    finished = 0
+    # Chunks that arrived ahead of their turn
+    waiting = {}
+    current = (0, 0)
+    while finished < len(tasks):
+        while submitted < min(finished + window, len(tasks)):
+            pool.apply_async(_enumerate_partition, (tasks[submitted],))
+            submitted += 1
+        if deterministic:
+            while current not in waiting:
+                partition_index, chunk_index, sentences, last = results.get()
+                waiting[(partition_index, chunk_index)] = (sentences, last)
+            sentences, last = waiting.pop(current)
+            current = (current[0] + 1, 0) if last else (current[0], current[1] + 1)
+        else:
+            _, _, sentences, last = results.get()
+        if isinstance(sentences, Exception):
+            raise sentences
+        if last:
+            finished += 1
+        yield sentences
+
+
+def enumerate_parallel(generator, start_tree, split_depth=2, processes=None, branch_cap=None, unique=False,
+                       deterministic=True, chunk_size=1000):
+    """
+    Enumerate the grammar with a process pool. The frontier is partitioned at split_depth and each partition is
+    enumerated by a worker. Workers send back sentences as tuples of symbol IDs in chunks, which are turned back into
+    trees here as they arrive.
+    :param generator: Generator with the rules loaded
+    :param start_tree: the list of tokens to begin expanding
+    :param split_depth: how many expansions deep to partition the frontier
+    :param processes: size of the pool. Defaults to the number of CPUs
+    :param branch_cap: limit on the number of different branches to pursue
+    :param unique: drop sentences that were already produced (before metadata is extracted)
+    :param deterministic: yield sentences in the same order as generator.enumerate. Otherwise, chunks are
+        yielded as they arrive
+    :param chunk_size: most sentences a worker sends back at once
+    :return: generator of sentence trees
+    """
+    compiled = generator.compiled
+    # Intern the start tree's tokens before the grammar is sent to the workers
+    partitions = partition_derivations(generator, start_tree, split_depth, branch_cap=branch_cap)
+    tasks = [(i, partition, branch_cap, unique, chunk_size) for i, partition in enumerate(partitions)]
+    processes = processes or multiprocessing.cpu_count()
+    # Workers wait when the parent falls behind, rather than piling up sentences
+    results = multiprocessing.Queue(4 * processes)
+    seen = set()
+    with multiprocessing.Pool(processes, initializer=_init_enumeration_worker, initargs=(compiled, results)) as pool:
+        for sentences in _partition_chunks(pool, results, tasks, 2 * processes, deterministic):
+            for ids in sentences:
+                if unique:
+                    if ids in seen:
+                        continue
+                    seen.add(ids)
+                sentence = Tree("expression", compiled.to_tokens(ids))
+                assert not has_nonterminals(sentence)
+                yield sentence
+
+
+def _init_semantics_worker(generator_type, grammar_format_version, rules, semantics):
+    global _worker_generator
+    _worker_generator = generator_type(None, grammar_format_version=grammar_format_version)
+    _worker_generator.rules = rules
+    _worker_generator.semantics = semantics
+
+
+def _expand_semantics_partition(indices):
+    utterances = list(_worker_generator.semantics.keys())
+    pairs = []
+    for i in indices:
+        pairs.extend(_worker_generator.generate(utterances[i], False))
+    return pairs
+
+
+def expand_all_semantics_parallel(generator, processes=None, chunk_size=4, deterministic=True):
+    """
+    The same as generator.expand_all_semantics, but with each semantics rule expanded in a process pool.
+    :param generator: PairedGenerator with rules and semantics loaded
+    :param processes: size of the pool. Defaults to the number of CPUs
+    :param chunk_size: number of semantics rules to hand a worker at a time
+    :param deterministic: yield pairs in the same order as generator.expand_all_semantics. Otherwise, chunks are
+        yielded as they finish
+    :return: generator of (utterance, semantics) pairs
+    """
+    indices = list(range(len(generator.semantics)))
+    chunks = [indices[i:i + chunk_size] for i in range(0, len(indices), chunk_size)]
+    initargs = (type(generator), generator._grammar_format_version, generator.rules, generator.semantics)
+    with multiprocessing.Pool(processes, initializer=_init_semantics_worker, initargs=initargs) as pool:
+        if deterministic:
+            results = pool.imap(_expand_semantics_partition, chunks)
+        else:
+            results = pool.imap_unordered(_expand_semantics_partition, chunks)
+        for pairs in results:
+            yield from pairs
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import sys
+import threading
+
+import importlib_resources
+from lark import Lark
+
+from gpsr_command_understanding.generator import rule_cache
+from gpsr_command_understanding.generator.grammar import TypeConverter
+
+GENERATOR_GRAMMARS = {2018: importlib_resources.read_text("gpsr_command_understanding.resources", "generator.lark"),
+                      2019: importlib_resources.read_text("gpsr_command_understanding.resources", "generator.lark"),
+                      2021: importlib_resources.read_text("gpsr_command_understanding.resources", "generator.lark")}
+
+SEMANTIC_FORMS = {"lambda": importlib_resources.read_text("gpsr_command_understanding.resources", "lambda_ebnf.lark")}
+
+# Entry point for a whole grammar file. Line breaks end rules, so they can't be ignored like other whitespace
+FILE_RULES = r"""
+file_start: _NL* (rule _NL+)* rule?
+_NL: /(\r?\n)+/
+%override WS: /[ \t\f\r\x0b]+/
+"""
+
+# Parsers are built once per process and shared. Lark's LALR parsers keep no state between parse calls
+_parsers = {}
+_lock = threading.Lock()
+
+
+def generator_parser(grammar_format_version, use_cache=False):
+    """
+    :param grammar_format_version: key into GENERATOR_GRAMMARS
+    :param use_cache: opt in to letting Lark save the built parser next to the rule cache (see rule_cache.cache_dir)
+        and load it from there next time. Only applies when this call is the one that builds the shared parser
+    :return: the shared LALR parser for rule and sequence lines, with rule_start and expression_start entry points
+    """
+    def build():
+        return _lalr(GENERATOR_GRAMMARS[grammar_format_version], use_cache, start=['rule_start', 'expression_start'],
+                     transformer=TypeConverter())
+
+    return _shared(("generator", grammar_format_version), build)
+
+
+def generator_file_parser(grammar_format_version, use_cache=False):
+    """
+    :param grammar_format_version: key into GENERATOR_GRAMMARS
+    :param use_cache: see generator_parser
+    :return: the shared LALR parser for whole grammar files, with a file_start entry point whose children are rules
+    """
+    def build():
+        return _lalr(GENERATOR_GRAMMARS[grammar_format_version] + FILE_RULES, use_cache, start='file_start',
+                     transformer=TypeConverter())
+
+    return _shared(("generator file", grammar_format_version), build)
+
+
+def semantics_parser(grammar_spec=SEMANTIC_FORMS["lambda"], use_cache=False):
+    """
+    :param grammar_spec: text of a semantic form grammar, which may import rules from generator.lark
+    :param use_cache: see generator_parser
+    :return: the shared LALR parser for the grammar
+    """
+    def build():
+        # FIXME: Ensure that the import statement will work in different contexts
+        # This grammar uses an import statement, which will trigger a local search for the imported file.
+        # We aren't guaranteed that resources live as files (could be zipped up), so this will
+        # probably break for distribution.
+        with importlib_resources.path("gpsr_command_understanding.resources", "generator.lark") as path:
+            # When a grammar comes in as a string, lark will check where the main script is located
+            # to start its search. We'll manually point it to a path that importlib tells us has
+            # the imported grammar.
+            main = sys.modules['__main__']
+            had_file = hasattr(main, "__file__")
+            old_main = getattr(main, "__file__", None)
+            main.__file__ = path
+            try:
+                return _lalr(grammar_spec, use_cache, start='start')
+            finally:
+                # Clean up
+                if had_file:
+                    main.__file__ = old_main
+                else:
+                    del main.__file__
+
+    return _shared(("semantics", grammar_spec), build)
+
+
+def clear():
+    """
+    Forget every shared parser. They'll be rebuilt (or loaded from Lark's cache) on next use
+    """
+    with _lock:
+        _parsers.clear()
+
+
+def _shared(key, build):
+    parser = _parsers.get(key)
+    if parser is not None:
+        return parser
+    with _lock:
+        parser = _parsers.get(key)
+        if parser is None:
+            parser = build()
+            _parsers[key] = parser
+    return parser
+
+
+def _lalr(grammar_spec, use_cache, **options):
+    cache = False
+    directory = rule_cache.cache_dir() if use_cache else None
+    if directory:
+        try:
+            os.makedirs(directory, exist_ok=True)
+            # Lark checks the grammar, options and its own version against what's in the file, so one file per
+            # grammar text is enough
+            cache = os.path.join(directory, "lark-{}.cache".format(hashlib.sha1(grammar_spec.encode("utf-8")).hexdigest()))
+        except OSError:
+            cache = False
+    return Lark(grammar_spec, parser="lalr", cache=cache, **options)
@@ -0,0 +1,151 @@
+import gc
+import hashlib
+import os
+import pickle
+import tempfile
+
+import importlib_resources
+import lark
+from lark import Tree
+
+import gpsr_command_understanding
+from gpsr_command_understanding.generator.tokens import NonTerminal
+from gpsr_command_understanding.generator.tree_columns import TreeColumns
+
+
+# Bump whenever cached values change shape or meaning in a way the source fingerprint below can't see
+CACHE_FORMAT_VERSION = 2
+
+_code_fingerprint = None
+
+
+def code_fingerprint():
+    """
+    :return: hex digest of the generator package's source and the grammars it parses with. Computed once per process
+    """
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        digest = hashlib.sha1()
+        sources = [("gpsr_command_understanding.generator", name) for name in
+                   sorted(importlib_resources.contents("gpsr_command_understanding.generator")) if name.endswith(".py")]
+        sources += [("gpsr_command_understanding.resources", "generator.lark"),
+                    ("gpsr_command_understanding.resources", "lambda_ebnf.lark")]
+        for package, name in sources:
+            digest.update(name.encode("utf-8") + b"\0")
+            digest.update(importlib_resources.read_binary(package, name))
+        _code_fingerprint = digest.hexdigest()
+    return _code_fingerprint
+
+
+def cache_dir():
+    """
+    Where loaded rules are cached. Set GPSR_CACHE_DIR to move it, or to an empty string to turn caching off
+    :return: path, or None if caching is off
+    """
+    path = os.environ.get("GPSR_CACHE_DIR")
+    if path is None:
+        path = os.path.join(os.path.expanduser("~"), ".cache", "gpsr_command_understanding")
+    return path if path else None
+
+
+def cache_key(kind, options, files):
+    """
+    :param kind: what's being cached, e.g. "rules"
+    :param options: anything else that changes the result, as a repr-able value
+    :param files: list of files, each a list of lines
+    :return: hex digest that changes whenever any file's content, the options, CACHE_FORMAT_VERSION, or the source of
+        the generator package does
+    """
+    digest = hashlib.sha1()
+    digest.update(repr((kind, options, CACHE_FORMAT_VERSION, code_fingerprint(), gpsr_command_understanding.__version__,
+                        lark.__version__, pickle.HIGHEST_PROTOCOL)).encode("utf-8"))
+    for lines in files:
+        digest.update(b"\0")
+        for line in lines:
+            digest.update(line.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def content_lines(rules):
+    """
+    For keying values computed from rules that are already loaded, rather than from files
+    :param rules: dictionary from symbol to a production or a list of them, like a generator's rules or semantics
+    :return: list of lines, one per entry, that changes whenever anything in an entry does (wildcard metadata too)
+    """
+    return [describe(symbol) + " = " + describe(productions) + "\n" for symbol, productions in rules.items()]
+
+
+def describe(item):
+    """
+    :param item: a production, a list of them, or a token
+    :return: string that differs whenever anything in the item does, wildcard metadata included (unlike ==)
+    """
+    if isinstance(item, Tree):
+        return "(" + " ".join([item.data] + list(map(describe, item.children))) + ")"
+    if isinstance(item, list):
+        return "[" + " | ".join(map(describe, item)) + "]"
+    if isinstance(item, NonTerminal):
+        return str(item)
+    # Lark tokens show their type too
+    return repr(item)
+
+
+def load_cached(key):
+    """
+    :return: the cached value, or None on a miss
+    """
+    return _load(key + ".pkl", pickle.load, (pickle.UnpicklingError, EOFError, AttributeError, ImportError))
+
+
+def store_cached(key, value):
+    _store(key + ".pkl", lambda cache_file: pickle.dump(value, cache_file, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def load_columns(key):
+    """
+    :return: the cached TreeColumns, or None on a miss
+    """
+    return _load(key + ".cols", TreeColumns.load, (pickle.UnpicklingError, EOFError, AttributeError, ImportError,
+                                                   ValueError))
+
+
+def store_columns(key, columns):
+    """
+    :param columns: TreeColumns. Stored in their own format (see TreeColumns.dump) rather than pickled
+    """
+    _store(key + ".cols", columns.dump)
+
+
+def _load(name, read, incompatible):
+    directory = cache_dir()
+    if not directory:
+        return None
+    # Unpickling makes lots of small objects and nothing to collect. Left on, the collector takes most of the time
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        with open(os.path.join(directory, name), "rb") as cache_file:
+            return read(cache_file)
+    except FileNotFoundError:
+        return None
+    except (OSError,) + incompatible:
+        # Unreadable or written by an incompatible version. It'll be overwritten
+        return None
+    finally:
+        if collecting:
+            gc.enable()
+
+
+def _store(name, write):
+    directory = cache_dir()
+    if not directory:
+        return
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Write somewhere else first so a reader never sees half a file
+        handle, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as cache_file:
+            write(cache_file)
+        os.replace(temp_path, os.path.join(directory, name))
+    except OSError as e:
+        print("Couldn't cache loaded rules: {}".format(e))
@@ -0,0 +1,130 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+
+from gpsr_command_understanding.generator.grammar import tree_printer
+
+
+class DiskBackedSet(object):
+    """
+    A set of strings kept in an SQLite file, so membership checks don't need every item in memory.
+    Only a 16 byte digest of each item is stored. Changes become durable when commit is called, together with
+    any state saved through put_state.
+    :param path: file to keep the set in. Created if it doesn't exist
+    """
+
+    def __init__(self, path):
+        self._connection = sqlite3.connect(path)
+        self._connection.execute("CREATE TABLE IF NOT EXISTS items (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value BLOB)")
+        self._connection.commit()
+
+    @staticmethod
+    def _digest(item):
+        return hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+
+    def add(self, item):
+        """
+        :return: True if the item wasn't in the set already
+        """
+        cursor = self._connection.execute("INSERT OR IGNORE INTO items VALUES (?)", (self._digest(item),))
+        return cursor.rowcount == 1
+
+    def __contains__(self, item):
+        cursor = self._connection.execute("SELECT 1 FROM items WHERE digest = ?", (self._digest(item),))
+        return cursor.fetchone() is not None
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM items").fetchone()[0]
+
+    def get_state(self, key):
+        row = self._connection.execute("SELECT value FROM state WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put_state(self, key, value):
+        self._connection.execute("INSERT OR REPLACE INTO state VALUES (?, ?)", (key, value))
+
+    def clear(self):
+        self._connection.execute("DELETE FROM items")
+        self._connection.execute("DELETE FROM state")
+        self._connection.commit()
+
+    def commit(self):
+        self._connection.commit()
+
+    def close(self):
+        self._connection.close()
+
+
+def grammar_fingerprint(rules):
+    """
+    :return: digest that changes whenever the rules (or their order) do
+    """
+    digest = hashlib.sha1()
+    for symbol, productions in rules.items():
+        digest.update(str(symbol).encode("utf-8"))
+        for production in productions:
+            digest.update(b"\t" + tree_printer(production).encode("utf-8"))
+        digest.update(b"\n")
+    return digest.hexdigest()
+
+
+def stream_enumeration(generator, start_tree, out_path, state_path, branch_cap=None, checkpoint_every=100000,
+                       limit=None):
+    """
+    Enumerate the grammar straight to a file, one sentence per line, without holding the sentences in memory.
+    Sentences have their metadata removed and are deduplicated against a DiskBackedSet at state_path.
+    The DFS stack is checkpointed into the same file. If a checkpoint is there when this is called, the output
+    is truncated back to what had been written at that checkpoint and enumeration picks up where it stopped.
+    :param generator: Generator with the rules loaded
+    :param start_tree: the list of tokens to begin expanding
+    :param out_path: file to write sentences to
+    :param state_path: file for the deduplication set and checkpoints. Delete it to start over
+    :param branch_cap: limit on the number of different branches to pursue
+    :param checkpoint_every: number of enumerated sentences between checkpoints
+    :param limit: stop (after checkpointing) once this many sentences have been enumerated in this call
+    :return: tuple of the number of sentences in the output file and whether the enumeration is finished
+    """
+    seen = DiskBackedSet(state_path)
+    fingerprint = grammar_fingerprint(generator.rules) + repr((str(start_tree), branch_cap))
+    checkpoint = seen.get_state("checkpoint")
+    if checkpoint is not None:
+        saved_fingerprint, offset, written, stack = pickle.loads(checkpoint)
+        if saved_fingerprint != fingerprint:
+            seen.close()
+            raise RuntimeError("{} was checkpointed with a different grammar. Delete it to start over".format(state_path))
+        out_file = open(out_path, "r+b")
+        out_file.truncate(offset)
+        out_file.seek(offset)
+    else:
+        # Anything in here is left over from a run that was killed before its first checkpoint
+        seen.clear()
+        stack = [generator.start_derivation(start_tree)]
+        written = 0
+        out_file = open(out_path, "wb")
+
+    def save_checkpoint():
+        out_file.flush()
+        os.fsync(out_file.fileno())
+        seen.put_state("checkpoint", pickle.dumps((fingerprint, out_file.tell(), written, stack)))
+        seen.commit()
+
+    enumerated = 0
+    try:
+        for sentence in generator.enumerate_from(stack, branch_cap=branch_cap):
+            sentence, _ = generator.extract_metadata(sentence)
+            line = tree_printer(sentence)
+            if seen.add(line):
+                out_file.write(line.encode("utf-8") + b"\n")
+                written += 1
+            enumerated += 1
+            if limit is not None and enumerated >= limit:
+                break
+            if enumerated % checkpoint_every == 0:
+                save_checkpoint()
+        save_checkpoint()
+    finally:
+        out_file.close()
+        seen.close()
+    return written, len(stack) == 0
@@ -2,8 +2,38 @@
 
 
 class NonTerminal(object):
+    """
+    Tokens are immutable so that their hash can be computed once, when they're constructed. Use replace to get a
+    modified copy.
+    """
+    __slots__ = ("name", "_hash")
+
     def __init__(self, name):
-        self.name = name
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "_hash", hash(self.__str__()))
+
+    def __setattr__(self, key, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __delattr__(self, key):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+
+    def __reduce__(self):
+        return type(self), (self.name,)
+
+    # Nothing can change, so copies can share
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def replace(self, **changes):
+        """
+        :param changes: constructor arguments to override
+        :return: a copy with the changes applied
+        """
+        return type(self)(changes.get("name", self.name))
 
     def to_human_readable(self):
         return "$" + self.name
@@ -12,13 +42,15 @@ class NonTerminal(object):
         return "NonTerminal({})".format(self.name)
 
     def __hash__(self):
-        return hash(self.__str__())
+        return self._hash
 
     def __eq__(self, other):
         return isinstance(other, NonTerminal) and self.name == other.name
 
 
 class WildCard(NonTerminal):
+    __slots__ = ()
+
     def __init__(self, name):
         super(WildCard, self).__init__(name)
 
@@ -36,15 +68,44 @@ class ComplexWildCard(WildCard):
     """
     A nonterminal type representing some object, location, gesture, category, or name.
     """
+    __slots__ = ("metadata", "_key")
 
     def __init__(self, name, type=None, wildcard_id=None, obfuscated=False, meta=None, conditions=None):
-        self.obfuscated = obfuscated
-        self.type = type.strip() if type else None
-        self.id = wildcard_id
-        self.metadata = meta
-        self.conditions = conditions if conditions else []
+        # Everything equality looks at. Metadata is only along for the ride
+        object.__setattr__(self, "_key", (name, type.strip() if type else None, wildcard_id, obfuscated,
+                                          conditions if conditions else []))
+        object.__setattr__(self, "metadata", meta)
         super(ComplexWildCard, self).__init__(name)
 
+    @property
+    def type(self):
+        return self._key[1]
+
+    @property
+    def id(self):
+        return self._key[2]
+
+    @property
+    def obfuscated(self):
+        return self._key[3]
+
+    @property
+    def conditions(self):
+        return self._key[4]
+
+    def __reduce__(self):
+        return type(self), (self.name, self.type, self.id, self.obfuscated, self.metadata, self.conditions)
+
+    def replace(self, **changes):
+        """
+        :param changes: constructor arguments to override
+        :return: a copy with the changes applied
+        """
+        args = {"name": self.name, "type": self.type, "wildcard_id": self.id, "obfuscated": self.obfuscated,
+                "meta": self.metadata, "conditions": self.conditions}
+        args.update(changes)
+        return ComplexWildCard(**args)
+
     def __str__(self):
         return "Wildcard(" + self.to_human_readable()[1:-1] + ')'
 
@@ -77,14 +138,14 @@ class ComplexWildCard(WildCard):
         items = filter(lambda x: x is not None, items)
         return "_".join(map(str, items))
 
-    def __hash__(self):
-        return hash(self.__str__())
-
     def __eq__(self, other):
-        return isinstance(other,
-                          WildCard) and self.name == other.name and \
-                          self.type == other.type and self.id == other.id and \
-                          self.obfuscated == other.obfuscated and self.conditions == other.conditions
+        if isinstance(other, ComplexWildCard):
+            return self._key == other._key
+        # Plain wildcards are just a name
+        return isinstance(other, WildCard) and self._key == (other.name, None, None, False, [])
+
+    # Defining __eq__ would otherwise drop the inherited hash
+    __hash__ = NonTerminal.__hash__
 
 
 # The GPSR grammars all have this as their root
@@ -0,0 +1,181 @@
+import pickle
+import sys
+from array import array
+
+from lark import Tree, Token
+
+# Bump whenever the layout below changes. Files with another version are treated as missing
+FORMAT_VERSION = 1
+_MAGIC = b"gpsr-tree-columns"
+
+
+class TreeColumns(object):
+    """
+    A list of trees stored as columns: a table of the distinct leaves, a table of node labels, one integer column
+    holding every tree in preorder, and an index of where each tree starts in it. A node is -1 - its label's position
+    followed by its number of children; a leaf is its position in the leaf table. Trees are rebuilt on access.
+    :param unique: don't append trees that are already stored
+    """
+
+    def __init__(self, unique=False):
+        self.leaves = []
+        self.labels = []
+        self.code = array("i")
+        self.index = array("i")
+        self._unique = unique
+        self._leaf_ids = {}
+        self._label_ids = {}
+        # Code of each tree, for membership checks. Built on first use
+        self._members = None
+
+    @staticmethod
+    def from_trees(trees, unique=False):
+        columns = TreeColumns(unique)
+        for tree in trees:
+            columns.append(tree)
+        return columns
+
+    @staticmethod
+    def _leaf_key(leaf):
+        # Lark tokens compare equal to plain strings, and wildcards don't compare their metadata
+        return type(leaf), leaf.type if isinstance(leaf, Token) else None, str(leaf)
+
+    def append(self, tree):
+        """
+        :return: True if the tree was stored
+        """
+        start = len(self.code)
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Tree):
+                self.code.append(-1 - self._intern(self._label_ids, self.labels, node.data, node.data))
+                self.code.append(len(node.children))
+                stack.extend(reversed(node.children))
+            else:
+                self.code.append(self._intern(self._leaf_ids, self.leaves, self._leaf_key(node), node))
+        encoded = self.code[start:].tobytes()
+        if self._unique:
+            if encoded in self._member_codes():
+                del self.code[start:]
+                return False
+            self._members.add(encoded)
+        elif self._members is not None:
+            self._members.add(encoded)
+        self.index.append(start)
+        return True
+
+    @staticmethod
+    def _intern(ids, table, key, value):
+        found = ids.get(key)
+        if found is None:
+            found = len(table)
+            ids[key] = found
+            table.append(value)
+        return found
+
+    def _member_codes(self):
+        if self._members is None:
+            self._members = {self._slice(i).tobytes() for i in range(len(self.index))}
+        return self._members
+
+    def _slice(self, i):
+        end = self.index[i + 1] if i + 1 < len(self.index) else len(self.code)
+        return self.code[self.index[i]:end]
+
+    def _encode(self, tree):
+        """
+        :return: the tree's code, or None if it has a leaf or label that isn't stored (so it can't be either)
+        """
+        code = array("i")
+        stack = [tree]
+        while stack:
+            node = stack.pop()
+            if isinstance(node, Tree):
+                label = self._label_ids.get(node.data)
+                if label is None:
+                    return None
+                code.append(-1 - label)
+                code.append(len(node.children))
+                stack.extend(reversed(node.children))
+            else:
+                leaf = self._leaf_ids.get(self._leaf_key(node))
+                if leaf is None:
+                    return None
+                code.append(leaf)
+        return code
+
+    def __contains__(self, tree):
+        code = self._encode(tree)
+        return code is not None and code.tobytes() in self._member_codes()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __iter__(self):
+        for i in range(len(self.index)):
+            yield self[i]
+
+    def __getitem__(self, i):
+        code, leaves, labels = self.code, self.leaves, self.labels
+        position = self.index[i]
+        # Nodes still missing children, with how many they're missing
+        open_nodes = []
+        while True:
+            value = code[position]
+            position += 1
+            if value >= 0:
+                item = leaves[value]
+            else:
+                item = Tree(labels[-1 - value], [])
+                remaining = code[position]
+                position += 1
+                if remaining:
+                    open_nodes.append([item, remaining])
+                    continue
+            # Attach the finished item, and any parents it finishes in turn
+            while open_nodes:
+                parent = open_nodes[-1]
+                parent[0].children.append(item)
+                parent[1] -= 1
+                if parent[1]:
+                    break
+                item = open_nodes.pop()[0]
+            else:
+                return item
+
+    def dump(self, out):
+        """
+        :param out: binary file. Writes a header line, then the leaf and label tables, then the code and index columns
+        """
+        tables = pickle.dumps((self.leaves, self.labels), protocol=pickle.HIGHEST_PROTOCOL)
+        code, index = self.code.tobytes(), self.index.tobytes()
+        header = [_MAGIC.decode("ascii"), FORMAT_VERSION, sys.byteorder, self.code.itemsize, int(self._unique),
+                  len(tables), len(code), len(index)]
+        out.write((" ".join(map(str, header)) + "\n").encode("ascii"))
+        out.write(tables)
+        out.write(code)
+        out.write(index)
+
+    @staticmethod
+    def load(in_file):
+        """
+        :param in_file: binary file written by dump
+        :return: TreeColumns, or None if it was written in another format
+        """
+        header = in_file.readline().split()
+        if len(header) != 8 or header[0] != _MAGIC or int(header[1]) != FORMAT_VERSION or \
+                header[2].decode("ascii") != sys.byteorder or int(header[3]) != array("i").itemsize:
+            return None
+        table_length, code_length, index_length = map(int, header[5:])
+        columns = TreeColumns(bool(int(header[4])))
+        columns.leaves, columns.labels = pickle.loads(in_file.read(table_length))
+        code, index = in_file.read(code_length), in_file.read(index_length)
+        if len(code) != code_length or len(index) != index_length:
+            # Cut short
+            return None
+        columns.code.frombytes(code)
+        columns.index.frombytes(index)
+        columns._leaf_ids = {TreeColumns._leaf_key(leaf): i for i, leaf in enumerate(columns.leaves)}
+        columns._label_ids = {label: i for i, label in enumerate(columns.labels)}
+        return columns
@@ -1,12 +1,15 @@
 import operator
 
-from copy import deepcopy, copy
+from collections import OrderedDict
+from copy import deepcopy
 from itertools import count
 
 import editdistance
 import lark
-from lark import Transformer, Lark, Tree
+from lark import Lark, Tree
 
+from gpsr_command_understanding.generator.compiled_grammar import CompiledGrammar, ChoiceSymbol
+from gpsr_command_understanding.generator.derivation import is_void
 from gpsr_command_understanding.generator.generator import Generator
 from gpsr_command_understanding.generator.grammar import DiscardVoid, DiscardMeta
 from gpsr_command_understanding.generator.knowledge import AnonymizedKnowledgebase
@@ -16,52 +19,61 @@ from gpsr_command_understanding.util import get_wildcards_forest
 from queue import PriorityQueue
 
 
-class ToEBNF(Transformer):
-    def __default__(self, data, children, meta):
-        return " ".join(map(str, children))
-
-    def expression(self, children):
-        output = ""
-        for child in children:
-            if isinstance(child, WildCard):
-                output += " " + "wild_" + child.to_snake_case().replace("?", "obf")
-            elif isinstance(child, NonTerminal):
-                output += " " + child.name.lower()
-            elif isinstance(child, tuple):
-                # This is how we smuggle choices up and avoid quoting them
-                # like other strings
-                output += child[1]
-            else:
-                output += " \"" + str(child) + "\""
-        return output
-
-    def non_terminal(self, children):
-        return "{}".format(" ".join(children))
-
-    def choice(self, children):
-        output = "("
-        for child in children:
-            if isinstance(child, WildCard):
-                output += " \"" + child.to_human_readable() + "\""
-            elif isinstance(child, NonTerminal):
-                output += " " + child.name.lower()
-            else:
-                output += "\"" + child + "\""
-            output += " | "
-        return ("choice", output[:-3] + ")")
+def expr_builder(item):
+    return Tree("expression", [item])
 
-    def rule(self, children):
-        return "{}: {}".format(children[0], children[1])
 
-    def constant_placeholder(self, children):
-        return "\"" + " ".join(children) + "\""
+def ebnf_rule_name(symbol):
+    if isinstance(symbol, WildCard):
+        # Question marks aren't allowed in non-term names
+        return ("wild_" + symbol.to_snake_case()).replace("?", "obf")
+    return symbol.name.lower()
 
-    def __call__(self, production):
-        return self.transform(production)
 
+class CompiledToEBNF(object):
+    """
+    Writes the EBNF for a compiled grammar. The text for each symbol ID is built once and reused for every
+    production it appears in.
+    """
 
-def expr_builder(item):
-    return Tree("expression", [item])
+    def __init__(self, compiled):
+        self.compiled = compiled
+        self._fragments = {}
+
+    def fragment(self, symbol_id):
+        fragment = self._fragments.get(symbol_id)
+        if fragment is None:
+            symbol = self.compiled.symbols[symbol_id]
+            if is_void(symbol):
+                # Void wildcards are for producing metadata during generation. We'll never see them as input
+                fragment = ""
+            elif isinstance(symbol, (WildCard, NonTerminal)):
+                fragment = " " + ebnf_rule_name(symbol)
+            elif isinstance(symbol, ChoiceSymbol):
+                fragment = " (" + " |".join(self.production(option)
+                                            for option in self.compiled.productions[symbol_id]) + " )"
+            else:
+                fragment = " \"" + str(symbol) + "\""
+            self._fragments[symbol_id] = fragment
+        return fragment
+
+    def production(self, production):
+        return "".join(map(self.fragment, production.tokens))
+
+    def rule(self, name, symbols):
+        """
+        :param name: EBNF name of the rule
+        :param symbols: every symbol that maps to this name. Their productions are merged
+        """
+        productions = []
+        for symbol in symbols:
+            # Only skip what an earlier symbol already contributed; repeats within a rule are left as written
+            merged = set(productions)
+            for production in self.compiled.productions[self.compiled.ids[symbol]]:
+                production = self.production(production)
+                if production not in merged:
+                    productions.append(production)
+        return "!" + name + ": (" + "\n\t| ".join(productions) + " )\n"
 
 
 class GrammarBasedParser(object):
@@ -75,7 +87,6 @@ class GrammarBasedParser(object):
         self.case_sensitive = case_sensitive
         # We need to destructively modify the rules a bit
         rules = deepcopy(grammar_rules)
-        rch_to_ebnf = ToEBNF()
         as_ebnf = ""
         void_remover = DiscardVoid()
         meta_remover = DiscardMeta()
@@ -100,29 +111,23 @@ class GrammarBasedParser(object):
                 anon_replacements = set(
                     gen.generate_groundings(expr_builder(wildcard), ignore_types=True, apply_obfuscation=False))
                 if isinstance(wildcard, ComplexWildCard):
-                    obf_copy = copy(wildcard)
-                    obf_copy.obfuscated = True
+                    obf_copy = wildcard.replace(obfuscated=True)
                     obfuscated_groundings = set(gen.generate_groundings(expr_builder(obf_copy), ignore_types=True))
                     anon_replacements.union(obfuscated_groundings)
                 rules[wildcard] = [expr_builder(wildcard.to_human_readable())] + list(anon_replacements)
 
-        for non_term, productions in rules.items():
-            # TODO: bake this into WildCard and NonTerminal types
-            non_term_name = non_term.name.lower()
-            if isinstance(non_term, WildCard):
-                if non_term.name == "void":
-                    # Void rules are for producing metadata during generation, they don't help during parsing
-                    # because we'll never see this metadata as input
-                    continue
-                non_term_name = "wild_" + non_term.to_snake_case()
-                # Question marks aren't allowed in non-term names
-                non_term_name = non_term_name.replace("?", "obf")
-            line = "!" + non_term_name + ": ("
-            for production in productions:
-                void_remover.visit(production)
-                line += rch_to_ebnf(production) + "\n\t| "
-
-            line = line[:-4] + " )\n"
+        # Wildcards that only differ by their conditions map to the same rule, so group symbols by name
+        symbols_by_name = OrderedDict()
+        for non_term in rules.keys():
+            if isinstance(non_term, WildCard) and non_term.name == "void":
+                # Void rules are for producing metadata during generation, they don't help during parsing
+                # because we'll never see this metadata as input
+                continue
+            symbols_by_name.setdefault(ebnf_rule_name(non_term), []).append(non_term)
+
+        to_ebnf = CompiledToEBNF(CompiledGrammar(rules))
+        for non_term_name, symbols in symbols_by_name.items():
+            line = to_ebnf.rule(non_term_name, symbols)
             if not self.case_sensitive:
                 line = line.lower()
             as_ebnf += line
@@ -135,6 +140,14 @@ class GrammarBasedParser(object):
 """
         self._parser = Lark(as_ebnf, start='main')
 
+    @staticmethod
+    def from_generator(generator, case_sensitive=False):
+        """
+        The parser for a generator's rules, kept in its artifacts until any of the rules is reloaded
+        """
+        return generator.derived(("grammar parser", case_sensitive), list(generator.rules.keys()),
+                                 lambda: GrammarBasedParser(generator.rules, case_sensitive=case_sensitive))
+
     def __call__(self, utterance, verbose=False):
         try:
             if self.case_sensitive:
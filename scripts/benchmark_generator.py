@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+"""
+Timing harness for the generator hot paths. Run from the repository root, e.g.
+
+    python scripts/benchmark_generator.py enumerate --year 2019 --task gpsr
+"""
+import argparse
+import itertools
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from random import Random
+from string import printable
+
+from gpsr_command_understanding.generator.generator import Generator
+from gpsr_command_understanding.generator.loading_helpers import load, load_2018, read_lines, GRAMMAR_YEAR_TO_MODULE
+from gpsr_command_understanding.generator.tokens import ROOT_SYMBOL
+from gpsr_command_understanding.util import get_wildcards_forest
+
+
+def load_generator(year, task, expand_shorthand=True, use_cache=True):
+    if year == 2018:
+        return load_2018(GRAMMAR_YEAR_TO_MODULE[2018], expand_shorthand=expand_shorthand, use_cache=use_cache)
+    generator = Generator(None, grammar_format_version=year)
+    load(generator, task, GRAMMAR_YEAR_TO_MODULE[year], expand_shorthand=expand_shorthand, use_cache=use_cache)
+    return generator
+
+
+def report(name, count, elapsed, unit):
+    print("{:>24}: {:>9} {} in {:7.3f}s ({:.0f} {}/sec)".format(name, count, unit, elapsed, count / elapsed, unit))
+
+
+def bench_enumerate(args):
+    generator = load_generator(args.year, args.task)
+    candidates = [("generate (indexed)", generator.generate), ("enumerate (persistent)", generator.enumerate)]
+    for name, method in candidates:
+        start = time.perf_counter()
+        count = sum(1 for _ in itertools.islice(method(ROOT_SYMBOL, branch_cap=args.branch_cap), args.limit))
+        report(name, count, time.perf_counter() - start, "sentences")
+
+
+def bench_load(args):
+    for year, task in [(2018, "gpsr"), (2019, "gpsr"), (2019, "egpsr"), (2021, "gpsr"), (2021, "egpsr")]:
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            generator = load_generator(year, task, expand_shorthand=not args.lazy, use_cache=not args.no_cache)
+        elapsed = time.perf_counter() - start
+        report("{} {}".format(year, task), len(generator.rules) * args.repeat, elapsed, "rules")
+        tracemalloc.start()
+        generator = load_generator(year, task, expand_shorthand=not args.lazy, use_cache=not args.no_cache)
+        generator.compiled
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        productions = sum(len(symbol_productions) for symbol_productions in generator.rules.values())
+        print("{:>24}: {} productions, {:.0f} KB loaded".format("", productions, size / 1024))
+
+
+GRAMMAR_FILES = {2018: ["common_rules.txt", "gpsr_category_1_grammar.txt", "gpsr_category_2_grammar.txt",
+                        "gpsr_category_3_grammar.txt"],
+                 2019: ["common_rules.txt", "gpsr.txt", "egpsr.txt"],
+                 2021: ["common_rules.txt", "gpsr.txt", "egpsr.txt"]}
+
+
+def bench_parse(args):
+    for year, names in GRAMMAR_FILES.items():
+        generator = Generator(None, grammar_format_version=year)
+        for name in names:
+            lines = read_lines(GRAMMAR_YEAR_TO_MODULE[year], name)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                # What load_rules used to do
+                for line in lines:
+                    generator.parse_production_rule(re.sub("[^{}]+".format(printable), "", line.strip()), expand=False)
+            per_line = (time.perf_counter() - start) / args.repeat
+            timings = []
+            for _ in range(args.repeat):
+                generator.rules = {}
+                generator.load_rules([lines], expand_shorthand=False, timings=timings)
+            print("{:>32}: {:>5} lines, {:7.4f}s line by line, {:7.4f}s in one pass".format(
+                "{} {}".format(year, name), len(lines), per_line, min(timings)))
+
+
+def bench_startup(args):
+    # Each run is a fresh interpreter, so only the on-disk caches carry over between them
+    script = "import time; start = time.perf_counter(); " \
+             "from gpsr_command_understanding.demo.parse_utterance import build_parser; build_parser(); " \
+             "print(time.perf_counter() - start)"
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for name, directory in [("no cache", ""), ("cold cache", cache_dir), ("warm cache", cache_dir)]:
+            env = dict(os.environ, GPSR_CACHE_DIR=directory)
+            times = []
+            for _ in range(args.repeat):
+                output = subprocess.run([sys.executable, "-c", script], env=env, check=True, stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+                times.append(float(output.split()[-1]))
+                if name == "cold cache":
+                    break
+            print("{:>24}: {:7.3f}s to build parse_utterance's parser (best of {})".format(name, min(times), len(times)))
+
+
+def bench_sample(args):
+    generator = load_generator(args.year, args.task)
+    random_generator = Random(0)
+    start = time.perf_counter()
+    for _ in range(args.count):
+        generator.generate_random(ROOT_SYMBOL, random_generator=random_generator)
+    report("generate_random", args.count, time.perf_counter() - start, "sentences")
+
+    start = time.perf_counter()
+    samples = generator.sample_uniform(ROOT_SYMBOL, random_generator=random_generator)
+    count = sum(1 for _ in itertools.islice(samples, args.count))
+    report("sample_uniform", count, time.perf_counter() - start, "sentences")
+
+
+GROUNDING_COMMANDS = ["bring the {kobject 1} and the {kobject 2} to the {placement 1}",
+                      "put the {object 1 where category=\"drinks\"}, the {object 2 where category=\"drinks\"} and the "
+                      "{object 3} on the {placement 1} in the {room 1}",
+                      "tell {name 1}, {name 2} and {name 3} to meet {name 4} at the {beacon 1} or the {beacon 2}",
+                      "find the {object 1 where category=\"fruits\"}, {object 2 where category=\"fruits\"}, "
+                      "{object 3 where category=\"fruits\"}, {object 4 where category=\"fruits\"} and "
+                      "{object 5 where category=\"fruits\"}"]
+
+
+def bench_ground(args):
+    generator = load_generator(args.year, args.task)
+    for command in GROUNDING_COMMANDS:
+        tree = generator.sequence_parser.parse(command)
+        start = time.perf_counter()
+        count = sum(1 for _ in itertools.islice(generator.generate_grounding_assignments(tree), args.limit))
+        report("{} wildcards".format(len(set(get_wildcards_forest([tree])))), count, time.perf_counter() - start,
+               "assignments")
+
+        # Random groundings, like make_dataset --groundings: a randomized search against drawing indexes directly
+        for name, assignments in [("random search", generator.generate_grounding_assignments(tree, random_generator=Random(0))),
+                                  ("sampled", generator.sample_grounding_assignments(tree, Random(0)))]:
+            start = time.perf_counter()
+            count = sum(1 for _ in itertools.islice(assignments, args.samples))
+            report(name, count, time.perf_counter() - start, "assignments")
+
+    # What dataset generation does: one grounding for each of many sentences, so resolving domains dominates
+    sentences = [generator.extract_metadata(sentence)[0] for sentence in
+                 itertools.islice(generator.generate(ROOT_SYMBOL, random_generator=Random(0)), args.limit // 100)]
+    start = time.perf_counter()
+    for sentence in sentences:
+        next(generator.generate_grounding_assignments(sentence), None)
+    report("first grounding", len(sentences), time.perf_counter() - start, "sentences")
+    start = time.perf_counter()
+    for sentence in sentences:
+        next(generator.sample_grounding_assignments(sentence, Random(0)), None)
+    report("first sampled grounding", len(sentences), time.perf_counter() - start, "sentences")
+
+
+def bench_tokens(args):
+    generator = load_generator(args.year, args.task)
+    rules = generator.rules
+    productions = [production for symbol_productions in rules.values() for production in symbol_productions]
+    tokens = [token for production in productions for token in production.children]
+    symbols = list(rules.keys())
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for token in tokens:
+            token in rules
+    report("membership (tokens)", len(tokens) * args.repeat, time.perf_counter() - start, "lookups")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        for symbol in symbols:
+            rules[symbol]
+    report("rules[symbol]", len(symbols) * args.repeat, time.perf_counter() - start, "lookups")
+
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        get_wildcards_forest(productions)
+    report("get_wildcards_forest", len(productions) * args.repeat, time.perf_counter() - start, "productions")
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    sentences = list(itertools.islice(generator.enumerate(ROOT_SYMBOL), args.count))
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print("{:>24}: {:.0f} bytes each".format("enumerated sentence", (after - before) / len(sentences)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+
+    enumerate_parser = subparsers.add_parser("enumerate", help="sentences/sec for full-grammar enumeration")
+    enumerate_parser.add_argument("--year", default=2019, type=int)
+    enumerate_parser.add_argument("--task", default="gpsr")
+    enumerate_parser.add_argument("--branch-cap", default=None, type=int)
+    enumerate_parser.add_argument("--limit", default=None, type=int, help="stop after this many sentences")
+    enumerate_parser.set_defaults(func=bench_enumerate)
+
+    load_parser = subparsers.add_parser("load", help="time to load and expand the 2018/2019/2021 rule sets")
+    load_parser.add_argument("--repeat", default=5, type=int)
+    load_parser.add_argument("--no-cache", action="store_true", help="parse the rule files every time")
+    load_parser.add_argument("--lazy", action="store_true", help="leave choices in the rules instead of expanding them")
+    load_parser.set_defaults(func=bench_load)
+
+    parse_parser = subparsers.add_parser("parse", help="time to parse each rule file, without expanding shorthand")
+    parse_parser.add_argument("--repeat", default=5, type=int)
+    parse_parser.set_defaults(func=bench_parse)
+
+    startup_parser = subparsers.add_parser("startup", help="time for demo/parse_utterance.py to be ready")
+    startup_parser.add_argument("--repeat", default=3, type=int)
+    startup_parser.set_defaults(func=bench_startup)
+
+    sample_parser = subparsers.add_parser("sample", help="sentences/sec for random sampling")
+    sample_parser.add_argument("--year", default=2019, type=int)
+    sample_parser.add_argument("--task", default="gpsr")
+    sample_parser.add_argument("--count", default=10000, type=int)
+    sample_parser.set_defaults(func=bench_sample)
+
+    ground_parser = subparsers.add_parser("ground", help="assignments/sec for enumerating groundings of multi-wildcard commands")
+    ground_parser.add_argument("--year", default=2019, type=int)
+    ground_parser.add_argument("--task", default="gpsr")
+    ground_parser.add_argument("--limit", default=200000, type=int)
+    ground_parser.add_argument("--samples", default=1000, type=int, help="random groundings to draw for each command")
+    ground_parser.set_defaults(func=bench_ground)
+
+    tokens_parser = subparsers.add_parser("tokens", help="hashing cost of grammar tokens")
+    tokens_parser.add_argument("--year", default=2019, type=int)
+    tokens_parser.add_argument("--task", default="gpsr")
+    tokens_parser.add_argument("--repeat", default=200, type=int)
+    tokens_parser.add_argument("--count", default=100000, type=int, help="sentences to hold for the memory figure")
+    tokens_parser.set_defaults(func=bench_tokens)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
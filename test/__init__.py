@@ -0,0 +1,9 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# Loaders cache on disk by default. Keep what the tests write out of the user's cache
+_cache_dir = tempfile.mkdtemp(prefix="gpsr_test_cache_")
+os.environ["GPSR_CACHE_DIR"] = _cache_dir
+atexit.register(shutil.rmtree, _cache_dir, True)
@@ -1,17 +1,32 @@
 # coding: utf-8
+import itertools
+import math
 import os
+import tempfile
+from io import StringIO, BytesIO
 
 import unittest
+from collections import Counter
 from random import Random
 
-from lark import Tree
+from lark import Tree, Token
 
+from gpsr_command_understanding.generator.compiled_grammar import CompiledGrammar, ChoiceSymbol
+from gpsr_command_understanding.generator.counting import DerivationCounter
 from gpsr_command_understanding.generator.generator import Generator
+from gpsr_command_understanding.generator.grammar import tree_printer
+from gpsr_command_understanding.generator.paired_generator import LambdaParserWrapper
+from gpsr_command_understanding.generator.parallel import enumerate_parallel
+from gpsr_command_understanding.generator import parser_registry, rule_cache
+from gpsr_command_understanding.generator.parser_registry import generator_parser
+from gpsr_command_understanding.generator.streaming import stream_enumeration, DiskBackedSet
 from gpsr_command_understanding.generator.tokens import ROOT_SYMBOL
-from gpsr_command_understanding.generator.grammar import NonTerminal, ComplexWildCard
-from gpsr_command_understanding.generator.knowledge import KnowledgeBase
+from gpsr_command_understanding.generator.tree_columns import TreeColumns
+from gpsr_command_understanding.generator.grammar import NonTerminal, ComplexWildCard, WildCard
+from gpsr_command_understanding.generator.knowledge import KnowledgeBase, AnonymizedKnowledgebase
 from gpsr_command_understanding.generator.loading_helpers import GRAMMAR_DIR_2018, \
-    GRAMMAR_DIR_2019, load_2018, load
+    GRAMMAR_DIR_2019, load_2018, load, load_rules_cached
+from gpsr_command_understanding.util import get_wildcards
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 
@@ -37,6 +52,215 @@ class TestGenerator(unittest.TestCase):
         sentences = list(self.generator.generate(NonTerminal("Main")))
         self.assertEqual(6, len(sentences))
 
+    def test_enumerate_sentences(self):
+        sentences = list(self.generator.enumerate(NonTerminal("Main")))
+        self.assertEqual(list(self.generator.generate(NonTerminal("Main"))), sentences)
+
+        generator = load_2018(GRAMMAR_DIR_2018)
+        self.assertEqual(list(generator.generate(ROOT_SYMBOL)), list(generator.enumerate(ROOT_SYMBOL)))
+        self.assertEqual(list(generator.generate(ROOT_SYMBOL, branch_cap=2)),
+                         list(generator.enumerate(ROOT_SYMBOL, branch_cap=2)))
+
+    def test_lazy_shorthand(self):
+        expanded = load_2018(GRAMMAR_DIR_2018)
+        lazy = load_2018(GRAMMAR_DIR_2018, expand_shorthand=False)
+        self.assertLess(sum(map(len, lazy.rules.values())), sum(map(len, expanded.rules.values())))
+        self.assertEqual(sorted(tree_printer(sentence) for sentence in expanded.enumerate(ROOT_SYMBOL)),
+                         sorted(tree_printer(sentence) for sentence in lazy.enumerate(ROOT_SYMBOL)))
+        self.assertEqual(expanded.count_derivations(ROOT_SYMBOL), lazy.count_derivations(ROOT_SYMBOL))
+
+        compiled = lazy.compiled
+        polite = compiled.ids[NonTerminal("polite")]
+        self.assertEqual([tree_printer(production) for production in expanded.rules[NonTerminal("polite")]],
+                         [tree_printer(compiled.to_tree(production)) for _, production in compiled.resolved_productions(polite)])
+
+    def test_indexed_sentence(self):
+        compiled = self.generator.compiled
+        sentence = compiled.compile_tokens(("bring", NonTerminal("when"), "and", NonTerminal("speak")))
+        self.assertEqual((1, 3), sentence.frontier)
+        production = compiled.compile_tokens(("a", NonTerminal("bring"), "b", NonTerminal("wild")))
+        substituted = sentence.substitute(0, production)
+        self.assertEqual(["bring", "a", NonTerminal("bring"), "b", NonTerminal("wild"), "and", NonTerminal("speak")],
+                         compiled.to_tokens(substituted.tokens))
+        self.assertEqual((2, 4, 6), substituted.frontier)
+        self.assertEqual((1, 3), sentence.frontier)
+
+        voided = compiled.compile_tokens((ComplexWildCard("void"), NonTerminal("when")), discard_void=True)
+        self.assertEqual([NonTerminal("when")], compiled.to_tokens(voided.tokens))
+        self.assertEqual((0,), voided.frontier)
+
+    def test_compiled_grammar(self):
+        compiled = self.generator.compiled
+        when = compiled.ids[NonTerminal("when")]
+        self.assertTrue(compiled.is_open[when])
+        self.assertEqual([["later"], ["now"]], [compiled.to_tokens(p.tokens) for p in compiled.productions[when]])
+        bring = compiled.productions[compiled.ids[NonTerminal("bring")]][0]
+        self.assertEqual((len(bring.tokens) - 1,), bring.frontier)
+        self.assertFalse(compiled.is_open[bring.tokens[0]])
+
+        # Interning is stable, and tokens outside the grammar are terminals
+        self.assertEqual(when, compiled.intern(NonTerminal("when")))
+        self.assertFalse(compiled.is_open[compiled.intern("unseen")])
+
+        # Loading more rules invalidates the compiled form
+        self.generator.load_rules(StringIO("$extra = one more"))
+        self.assertIsNot(compiled, self.generator.compiled)
+        self.assertIn(NonTerminal("extra"), self.generator.compiled.ids)
+
+        # So does editing rules in place
+        when = NonTerminal("when")
+        self.generator.rules[when] = self.generator.rules[when] + [Tree("expression", ["soon"])]
+        self.assertEqual(8, len(list(self.generator.generate(NonTerminal("Main")))))
+        self.generator.rules[when].pop()
+        self.generator.rules.changed({when})
+        self.assertEqual(6, len(list(self.generator.generate(NonTerminal("Main")))))
+
+        # Choices that weren't expanded become anonymous symbols
+        generator = Generator(None, grammar_format_version=2018)
+        with open(os.path.join(FIXTURE_DIR, "grammar.txt")) as fixture_grammar_file:
+            generator.load_rules(fixture_grammar_file, expand_shorthand=False)
+        compiled = CompiledGrammar(generator.rules)
+        main = compiled.productions[compiled.ids[NonTerminal("Main")]]
+        self.assertEqual(1, len(main))
+        self.assertIsInstance(compiled.symbols[main[0].tokens[0]], ChoiceSymbol)
+        self.assertEqual(3, len(compiled.productions[main[0].tokens[0]]))
+        self.assertEqual(6, len(list(generator.generate(NonTerminal("Main")))))
+
+    def test_generated_wildcards_are_independent(self):
+        generator = load_2018(GRAMMAR_DIR_2018)
+        first = [generator.extract_metadata(sentence)[1] for sentence in generator.generate(ROOT_SYMBOL)]
+        second = [generator.extract_metadata(sentence)[1] for sentence in generator.generate(ROOT_SYMBOL)]
+        self.assertEqual([len(metadata) for metadata in first], [len(metadata) for metadata in second])
+
+    def test_stream_enumeration(self):
+        generator = load_2018(GRAMMAR_DIR_2018)
+        expected = []
+        for sentence in generator.enumerate(ROOT_SYMBOL):
+            line = tree_printer(generator.extract_metadata(sentence)[0])
+            if line not in expected:
+                expected.append(line)
+
+        with tempfile.TemporaryDirectory() as temp_dir:
+            out_path = os.path.join(temp_dir, "sentences.txt")
+            state_path = os.path.join(temp_dir, "sentences.state")
+            # Stop partway through a few times, like a job that keeps getting killed
+            written, finished = stream_enumeration(generator, ROOT_SYMBOL, out_path, state_path, checkpoint_every=100,
+                                                   limit=1000)
+            self.assertFalse(finished)
+            while not finished:
+                written, finished = stream_enumeration(generator, ROOT_SYMBOL, out_path, state_path,
+                                                       checkpoint_every=100, limit=1000)
+            with open(out_path) as out_file:
+                self.assertEqual(expected, out_file.read().splitlines())
+            self.assertEqual(len(expected), written)
+
+            seen = DiskBackedSet(state_path)
+            self.assertEqual(len(expected), len(seen))
+            self.assertIn(expected[0], seen)
+            self.assertNotIn("not a sentence", seen)
+            seen.close()
+
+            # Checkpoints only resume against the same grammar
+            generator.load_rules(StringIO("$extra = one more"))
+            with self.assertRaises(RuntimeError):
+                stream_enumeration(generator, ROOT_SYMBOL, out_path, state_path)
+
+    def test_rule_cache(self):
+        expected = load_2018(GRAMMAR_DIR_2018, use_cache=False).rules
+        previous = os.environ.get("GPSR_CACHE_DIR")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.environ["GPSR_CACHE_DIR"] = temp_dir
+            try:
+                self.assertEqual(expected, load_2018(GRAMMAR_DIR_2018).rules)
+                self.assertEqual(1, len(os.listdir(temp_dir)))
+                # A hit comes back the same, and merges into rules that are already there like load_rules does
+                self.assertEqual(expected, load_2018(GRAMMAR_DIR_2018).rules)
+                generator = Generator(None)
+                generator.load_rules(StringIO("$Main = extra"))
+                load_rules_cached(generator, [["$Main = cached"]])
+                self.assertEqual(["extra", "cached"], [tree_printer(production) for production in generator.rules[ROOT_SYMBOL]])
+                self.assertEqual(2, len(os.listdir(temp_dir)))
+                # Different content is a different entry
+                load_rules_cached(Generator(None), [["$Main = changed"]])
+                self.assertEqual(3, len(os.listdir(temp_dir)))
+                # So is a different cache format
+                key = rule_cache.cache_key("rules", (), [["$Main = changed"]])
+                rule_cache.CACHE_FORMAT_VERSION += 1
+                try:
+                    self.assertNotEqual(key, rule_cache.cache_key("rules", (), [["$Main = changed"]]))
+                finally:
+                    rule_cache.CACHE_FORMAT_VERSION -= 1
+            finally:
+                if previous is None:
+                    del os.environ["GPSR_CACHE_DIR"]
+                else:
+                    os.environ["GPSR_CACHE_DIR"] = previous
+
+    def test_tree_columns(self):
+        trees = list(self.generator.generate(NonTerminal("Main")))
+        trees.append(Tree("lambda", [Token("WORD", "a"), "a", Tree("empty", []), ComplexWildCard("name", obfuscated=True)]))
+        columns = TreeColumns.from_trees(trees + trees, unique=True)
+        self.assertEqual(len(trees), len(columns))
+        self.assertEqual(trees, list(columns))
+        self.assertIn(trees[-1], columns)
+        self.assertNotIn(Tree("expression", ["unseen"]), columns)
+
+        out = BytesIO()
+        columns.dump(out)
+        loaded = TreeColumns.load(BytesIO(out.getvalue()))
+        self.assertEqual(trees, list(loaded))
+        self.assertIn(trees[0], loaded)
+        self.assertFalse(loaded.append(trees[0]))
+        # Other formats are a miss
+        self.assertIsNone(TreeColumns.load(BytesIO(out.getvalue().replace(b"gpsr-tree-columns 1", b"gpsr-tree-columns 0", 1))))
+        self.assertIsNone(TreeColumns.load(BytesIO(out.getvalue()[:-1])))
+
+    def test_shared_parsers(self):
+        parser = generator_parser(2019)
+        self.assertIs(parser, generator_parser(2019))
+        self.assertIs(LambdaParserWrapper().parser, LambdaParserWrapper().parser)
+        parser_registry.clear()
+        rebuilt = generator_parser(2019)
+        self.assertIsNot(parser, rebuilt)
+        # Still parses the same way
+        generator = Generator(None)
+        generator.load_rules(StringIO("$Main = go to the {room}"))
+        self.assertEqual("go to the {location room}", tree_printer(generator.rules[ROOT_SYMBOL][0]))
+
+        # Lark only caches on disk when asked to
+        previous = os.environ.get("GPSR_CACHE_DIR")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.environ["GPSR_CACHE_DIR"] = temp_dir
+            try:
+                parser_registry.clear()
+                generator_parser(2019)
+                self.assertEqual([], os.listdir(temp_dir))
+                parser_registry.clear()
+                generator_parser(2019, use_cache=True)
+                self.assertEqual(1, len(os.listdir(temp_dir)))
+            finally:
+                parser_registry.clear()
+                if previous is None:
+                    del os.environ["GPSR_CACHE_DIR"]
+                else:
+                    os.environ["GPSR_CACHE_DIR"] = previous
+
+    def test_enumerate_parallel(self):
+        generator = load_2018(GRAMMAR_DIR_2018)
+        expected = [tree_printer(sentence) for sentence in generator.enumerate(ROOT_SYMBOL)]
+        for split_depth in (1, 3):
+            sentences = enumerate_parallel(generator, ROOT_SYMBOL, split_depth=split_depth, processes=2)
+            self.assertEqual(expected, [tree_printer(sentence) for sentence in sentences])
+        # Partitions come back in many chunks
+        sentences = enumerate_parallel(generator, ROOT_SYMBOL, split_depth=1, processes=2, chunk_size=7)
+        self.assertEqual(expected, [tree_printer(sentence) for sentence in sentences])
+
+        unique = [tree_printer(sentence) for sentence in enumerate_parallel(generator, ROOT_SYMBOL, processes=2,
+                                                                            unique=True)]
+        self.assertEqual(len(set(expected)), len(unique))
+        unordered = enumerate_parallel(generator, ROOT_SYMBOL, processes=2, deterministic=False, chunk_size=7)
+        self.assertEqual(sorted(expected), sorted(tree_printer(sentence) for sentence in unordered))
+
     def test_generate_all_2018_gpsr_sentences(self):
         generator = load_2018(GRAMMAR_DIR_2018)
 
@@ -140,3 +364,140 @@ class TestGenerator(unittest.TestCase):
                                         ])
         expected = expr_builder("sc1 o1 sc2")
         self.assertEqual(expected, self.generator.ground(test_tree))
+        # Every grounding is obfuscated the same way, however many are applied at once
+        expected = [expr_builder("sc1 o1 sc2"), expr_builder("sc2 o2 sc1")]
+        self.assertEqual(expected, list(self.generator.generate_groundings(test_tree)))
+        assignments = list(self.generator.generate_grounding_assignments(test_tree))
+        self.assertEqual(expected, self.generator.apply_grounding_assignments(test_tree, assignments))
+        self.assertEqual(expected, [self.generator.apply_grounding_assignment(test_tree, assignment) for assignment in assignments])
+
+    def test_knowledge_base_indexes(self):
+        kb = self.generator.knowledge_base
+        self.assertEqual({"l1", "l4"}, kb.with_attributes("location", [("isroom", True)]))
+        self.assertEqual({"l2"}, kb.with_attributes("location", [("isbeacon", True), ("isplacement", True)]))
+        self.assertEqual(set(), kb.with_attributes("location", [("isroom", True), ("isplacement", True)]))
+        self.assertEqual({"o1", "o2"}, kb.with_attributes("object", []))
+        with self.assertRaises(RuntimeError):
+            kb.with_attributes("object", [("UNKNOWNCONDITION", True)])
+        # Anything missing the attribute doesn't match, like before
+        anonymized = AnonymizedKnowledgebase()
+        self.assertEqual({"room0", "room1", "room2"}, anonymized.with_attributes("location", [("isroom", True)]))
+        self.assertEqual(set(), anonymized.with_attributes("location", [("isbeacon", True)]))
+
+    def test_obfuscation_tables(self):
+        kb = self.generator.knowledge_base
+        self.assertEqual(["sc2", "sc1", "sc2"], kb.obfuscate_all("object", ["o2", "o1", "o2"]))
+        self.assertEqual(["objects", "objects"], kb.obfuscate_all("category", ["c1", "c2"]))
+        self.assertEqual(["room"], kb.obfuscate_all("location", ["l1"], "room"))
+        # No location says what room it's in
+        with self.assertRaises(KeyError):
+            kb.obfuscate("location", "l2", "beacon")
+        self.assertEqual(["room1", "room1"], AnonymizedKnowledgebase().obfuscate_all("location", ["location0", "unknown"]))
+
+    def test_grounding_search(self):
+        first, room, second = ComplexWildCard("name", wildcard_id=1), ComplexWildCard("location", "room"), \
+            ComplexWildCard("name", wildcard_id=2)
+        test_tree = Tree("expression", [first, room, second])
+        assignments = [(assignment[first], assignment[room], assignment[second])
+                       for assignment in self.generator.generate_grounding_assignments(test_tree)]
+        # Knowledge base order, with the first wildcard varying slowest
+        names = ["n1", "n2", "n3", "n4"]
+        self.assertEqual([(a, r, b) for a in names for r in ["l1", "l4"] for b in names if a != b], assignments)
+
+        # Seeded searches find the same assignments, each once
+        seeded = [(assignment[first], assignment[room], assignment[second])
+                  for assignment in self.generator.generate_grounding_assignments(test_tree, random_generator=Random(1))]
+        self.assertEqual(24, len(set(seeded)))
+        self.assertEqual(sorted(assignments), sorted(seeded))
+
+        # More wildcards that must differ than there are values; there's nothing to search
+        test_tree = Tree("expression", [ComplexWildCard("name", wildcard_id=i) for i in range(4)] +
+                         [ComplexWildCard("object", wildcard_id=i, conditions={"category": "c1"}) for i in range(2)])
+        self.assertEqual([], list(self.generator.generate_grounding_assignments(test_tree)))
+
+    def test_sample_groundings(self):
+        first, room, second = ComplexWildCard("name", wildcard_id=1), ComplexWildCard("location", "room"), \
+            ComplexWildCard("name", wildcard_id=2)
+        test_tree = Tree("expression", [first, room, second])
+        kb_lists = {name: list(items) for name, items in self.generator.knowledge_base.by_name.items()}
+        everything = set((assignment[first], assignment[room], assignment[second])
+                         for assignment in self.generator.generate_grounding_assignments(test_tree))
+
+        samples = [(assignment[first], assignment[room], assignment[second]) for assignment in
+                   self.generator.sample_grounding_assignments(test_tree, Random(0), count=10)]
+        self.assertEqual(10, len(set(samples)))
+        self.assertTrue(set(samples).issubset(everything))
+
+        # Without a count, every assignment comes out once, even after rejection gives up
+        samples = [(assignment[first], assignment[room], assignment[second]) for assignment in
+                   self.generator.sample_grounding_assignments(test_tree, Random(0), max_rejections=5)]
+        self.assertEqual(len(everything), len(samples))
+        self.assertEqual(everything, set(samples))
+        self.assertEqual(kb_lists, self.generator.knowledge_base.by_name)
+
+        grounded = self.generator.ground(test_tree, random_generator=Random(0))
+        self.assertEqual([], list(get_wildcards(grounded)))
+
+    def test_count_groundings(self):
+        generator = load_2018(GRAMMAR_DIR_2018)
+        templates = [generator.extract_metadata(sentence)[0]
+                     for sentence in itertools.islice(generator.generate(ROOT_SYMBOL, random_generator=Random(0)), 200)]
+        counts = generator.count_groundings(templates)
+        for template, count in zip(templates, counts):
+            # Exhausting the big ones takes too long
+            if count < 1000:
+                self.assertEqual(len(list(generator.generate_grounding_assignments(template))), count)
+        # Budgets cap what comes out, whichever order the groundings come in
+        for template, count in zip(templates, counts):
+            self.assertEqual(min(count, 3), len(list(generator.generate_groundings(template, count=3))))
+            self.assertEqual(min(count, 3), len(list(generator.generate_groundings(template, Random(0), count=3))))
+
+    def test_count_derivations(self):
+        self.assertEqual(6, self.generator.count_derivations(NonTerminal("Main")))
+
+        generator = load_2018(GRAMMAR_DIR_2018)
+        for branch_cap in (None, 1, 2):
+            self.assertEqual(len(list(generator.enumerate(ROOT_SYMBOL, branch_cap=branch_cap))),
+                             generator.count_derivations(ROOT_SYMBOL, branch_cap=branch_cap))
+
+        generator = Generator(None)
+        generator.load_rules(StringIO("$Main = $a | x\n$a = $b y\n$b = $Main | z"))
+        counter = DerivationCounter(generator.compiled)
+        self.assertEqual(math.inf, counter.count(NonTerminal("Main")))
+        self.assertEqual([[NonTerminal("Main"), NonTerminal("a"), NonTerminal("b"), NonTerminal("Main")]],
+                         counter.cycles)
+
+    def test_sample_uniform(self):
+        expected = set(tree_printer(sentence) for sentence in self.generator.enumerate(NonTerminal("Main")))
+        samples = itertools.islice(self.generator.sample_uniform(NonTerminal("Main"), random_generator=Random(0)), 6000)
+        counts = Counter(tree_printer(sentence) for sentence in samples)
+        self.assertEqual(expected, set(counts.keys()))
+        # Each of the six sentences is equally likely, even though $speak is a much shorter derivation than $when's
+        for count in counts.values():
+            self.assertTrue(800 < count < 1200)
+
+        generator = Generator(None)
+        generator.load_rules(StringIO("$Main = $a | $b\n$a = x | y\n$b = z"))
+        weights = {ROOT_SYMBOL: [1 if tree_printer(production) == "$b" else 0 for production in generator.rules[ROOT_SYMBOL]]}
+        samples = generator.sample_uniform(ROOT_SYMBOL, random_generator=Random(0), weights=weights)
+        self.assertEqual({"z"}, set(tree_printer(sentence) for sentence in itertools.islice(samples, 100)))
+
+        generator.load_rules(StringIO("$Main = $a | x\n$a = $Main y"))
+        with self.assertRaises(ValueError):
+            next(generator.sample_uniform(ROOT_SYMBOL))
+
+    def test_count_grounding_assignments(self):
+        test_trees = [
+            Tree("expression", [ComplexWildCard("name", wildcard_id=1), ComplexWildCard("name", wildcard_id=2)]),
+            Tree("expression", [ComplexWildCard("name"), ComplexWildCard("name", wildcard_id=1),
+                                ComplexWildCard("location", "room", wildcard_id=1), ComplexWildCard("name")]),
+            Tree("expression", [ComplexWildCard("location", "room", wildcard_id=1), ComplexWildCard("location", wildcard_id=2),
+                                ComplexWildCard("location", "placement", wildcard_id=3)]),
+            Tree("expression", [ComplexWildCard("location", wildcard_id=i) for i in range(6)]),
+            Tree("expression", [ComplexWildCard("object", wildcard_id=1, conditions={"canPourIn": True}),
+                                WildCard("pron"), ComplexWildCard("object", wildcard_id=2)])
+        ]
+        for tree in test_trees:
+            for ignore_types in (False, True):
+                expected = len(list(self.generator.generate_grounding_assignments(tree, ignore_types=ignore_types)))
+                self.assertEqual(expected, self.generator.count_grounding_assignments(tree, ignore_types=ignore_types))
@@ -1,12 +1,16 @@
 # coding: utf-8
+import copy
 import os
+import pickle
 import unittest
 
 import lark
 from lark import Lark
 
-from gpsr_command_understanding.generator.generator import GENERATOR_GRAMMARS
-from gpsr_command_understanding.generator.grammar import expand_shorthand, TypeConverter
+from gpsr_command_understanding.generator.generator import GENERATOR_GRAMMARS, Generator
+from gpsr_command_understanding.generator.grammar import expand_shorthand, TypeConverter, tree_printer, DiscardVoid, \
+    CombineExpressions, normalize_expressions
+from gpsr_command_understanding.generator.tokens import NonTerminal, WildCard, ComplexWildCard
 from gpsr_command_understanding.util import ParseForward
 
 GRAMMAR_DIR_2018 = "gpsr_command_understanding.resources.generator2018"
@@ -32,6 +36,24 @@ class TestGenerator(unittest.TestCase):
         test = self.rule_parser.parse("// Ignore this\n $test = But not this")
         self.assertNotEqual([], test.children)
 
+    def test_parse_rule_file(self):
+        lines = ["\ufeff; grammar name Test", "", "$test = {pron} went to the (mall | park)  ", "  # comment",
+                 "$test = $go $home // trailing comment", "$go = go"]
+        generator = Generator(None)
+        expected = []
+        for line in lines:
+            lhs, productions = generator.parse_production_rule(line.strip().replace("\ufeff", ""))
+            if lhs:
+                expected.append((lhs, productions))
+        self.assertEqual(expected, generator.parse_rule_file("\n".join(lines)))
+
+        timings = []
+        self.assertEqual(3, generator.load_rules([lines[:3], lines[3:]], timings=timings))
+        self.assertEqual(2, len(timings))
+        self.assertEqual(["{pron} went to the park", "{pron} went to the mall", "$go $home"],
+                         [tree_printer(production) for production in generator.rules[NonTerminal("test")]])
+        self.assertRaises(lark.exceptions.UnexpectedInput, generator.parse_rule_file, "$go = go\n$bad = (")
+
     def test_parse_rule(self):
         test = self.rule_parser.parse("$test = {pron} went to the mall and {location} $go $home")
         # TODO: Actually check this
@@ -129,6 +151,24 @@ class TestGenerator(unittest.TestCase):
         result = expand_shorthand(test)
         self.assertEqual(len(result), 3)
 
+        # The first choice varies slowest, and options come out last to first
+        test = self.sequence_parser.parse("(a | b (c | d)) x (y | z)")
+        result = [tree_printer(expansion) for expansion in expand_shorthand(test)]
+        self.assertEqual(["b d x z", "b d x y", "b c x z", "b c x y", "a x z", "a x y"], result)
+        for expansion in expand_shorthand(test):
+            self.assertFalse(any(subtree.data == "choice" for subtree in expansion.iter_subtrees()))
+
+    def test_normalize_expressions(self):
+        test = self.sequence_parser.parse("(a {void} | {void}) b (c (d {void} | e) | f)")
+        separate = copy.deepcopy(test)
+        DiscardVoid().visit(separate)
+        CombineExpressions().visit(separate)
+        normalize_expressions.visit(test)
+        self.assertEqual(separate, test)
+        for expansion in expand_shorthand(test):
+            self.assertEqual(["expression"], [subtree.data for subtree in expansion.iter_subtrees()])
+            self.assertFalse(any(isinstance(child, WildCard) and child.name == "void" for child in expansion.children))
+
     def test_parse_choice(self):
         test = self.sequence_parser.parse("( oneword | two words)")
         self.assertEqual(len(test.children[0].children), 2)
@@ -155,3 +195,22 @@ class TestGenerator(unittest.TestCase):
         test = self.sequence_parser.parse(test_rule)
         self.assertEqual(len(test.children), 1)
         self.assertEqual(len(test.children[0].metadata), 36)
+
+    def test_tokens_are_immutable(self):
+        wildcard = self.sequence_parser.parse("{object? 1 meta: test}").children[0]
+        with self.assertRaises(AttributeError):
+            wildcard.metadata = None
+        self.assertIs(wildcard, copy.deepcopy(wildcard))
+        self.assertEqual(hash(str(wildcard)), hash(wildcard))
+
+        stripped = wildcard.replace(meta=None)
+        self.assertEqual(["test"], wildcard.metadata)
+        self.assertIsNone(stripped.metadata)
+        self.assertEqual(wildcard, stripped)
+        self.assertEqual(hash(str(stripped)), hash(stripped))
+
+        unpickled = pickle.loads(pickle.dumps(wildcard))
+        self.assertEqual(wildcard, unpickled)
+        self.assertEqual(["test"], unpickled.metadata)
+        self.assertEqual(NonTerminal("go"), pickle.loads(pickle.dumps(NonTerminal("go"))))
+        self.assertEqual(WildCard("pron"), ComplexWildCard("pron"))
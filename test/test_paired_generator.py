@@ -1,16 +1,21 @@
 # coding: utf-8
+import copy
 import os
+import tempfile
 
 import unittest
 
 from lark import Tree, Token
 
+from gpsr_command_understanding.generator.generator import Generator
 from gpsr_command_understanding.generator.tokens import ROOT_SYMBOL
-from gpsr_command_understanding.generator.grammar import NonTerminal, ComplexWildCard
+from gpsr_command_understanding.generator.grammar import NonTerminal, ComplexWildCard, PrintTemplate, SemanticsTemplate, \
+    tree_printer, DiscardMeta
 from gpsr_command_understanding.generator.knowledge import KnowledgeBase
 from gpsr_command_understanding.generator.loading_helpers import load_paired_2018_by_cat, load_paired, GRAMMAR_DIR_2018, \
     GRAMMAR_DIR_2019, load_paired_2018, load_2018
-from gpsr_command_understanding.generator.paired_generator import PairedGenerator
+from gpsr_command_understanding.generator.paired_generator import PairedGenerator, pairs_without_placeholders, \
+    _grammar_sentences
 
 FIXTURE_DIR = os.path.join(os.path.dirname(__file__), "fixtures")
 
@@ -89,6 +94,23 @@ class TestPairedGenerator(unittest.TestCase):
         pairs = list(self.generator.generate(NonTerminal("Main")))
         self.assertEqual(6, len(pairs))
 
+    def test_expand_pair(self):
+        start = Tree("expression", [NonTerminal("bring")])
+        expansions = list(self.generator.expand_pair(start, None))
+        self.assertEqual(2, len(expansions))
+        sentence, semantics = expansions[0]
+        self.assertIsInstance(sentence, Tree)
+        self.assertEqual(["bring", "it", "to", NonTerminal("when")], sentence.children[:3] + sentence.children[4:])
+        self.assertIsNone(semantics)
+
+    def test_semantics_changed(self):
+        speak = Tree("expression", [NonTerminal("speak")])
+        self.assertEqual(["( speak )"], [tree_printer(logical) for _, logical in self.generator.generate(speak)])
+        # Lookups are indexed, so in place edits have to be announced
+        self.generator.semantics[speak] = self.generator.lambda_parser.parse("(talk)")
+        self.generator.semantics_changed([speak])
+        self.assertEqual(["( talk )"], [tree_printer(logical) for _, logical in self.generator.generate(speak)])
+
     def test_generate_pairs_2018(self):
         generator = load_2018(GRAMMAR_DIR_2018)
         paired_generator = load_paired_2018(GRAMMAR_DIR_2018)
@@ -97,6 +119,119 @@ class TestPairedGenerator(unittest.TestCase):
         sentences = list(generator.generate(ROOT_SYMBOL))
         self.assertEqual(len(pairs), len(sentences))
 
+    def test_pairs_without_placeholders_parallel(self):
+        generator = load_paired_2018(GRAMMAR_DIR_2018)
+        expected = pairs_without_placeholders(generator, use_cache=False)
+        self.assertEqual(list(expected.items()), list(pairs_without_placeholders(generator, processes=2, use_cache=False).items()))
+
+    def test_reload(self):
+        with open(os.path.join(FIXTURE_DIR, "grammar.txt")) as grammar_file, open(
+                os.path.join(FIXTURE_DIR, "semantics.txt")) as semantics_file:
+            grammar, semantics = grammar_file.readlines(), semantics_file.readlines()
+        self.assertEqual(set(), self.generator.reload_rules([grammar]))
+        self.assertEqual(set(), self.generator.reload_semantics_rules([semantics]))
+        expected = pairs_without_placeholders(self.generator, use_cache=False)
+        self.assertEqual(expected, pairs_without_placeholders(self.generator, incremental=True, use_cache=False))
+        speak, bring = Tree("expression", [NonTerminal("speak")]), Tree("expression", [NonTerminal("bring")])
+        speak_pairs = self.generator.expand_semantics(speak)
+        bring_pairs = self.generator.expand_semantics(bring)
+
+        # Only what can derive through $when is affected
+        grammar[3] = "$when = (now | later | soon)\n"
+        self.assertEqual({NonTerminal("Main"), NonTerminal("bring"), NonTerminal("when")},
+                         self.generator.reload_rules([grammar]))
+        self.assertIs(speak_pairs, self.generator.expand_semantics(speak))
+        self.assertIsNot(bring_pairs, self.generator.expand_semantics(bring))
+        self.assertEqual(6, len(self.generator.expand_semantics(bring)))
+
+        semantics[0] = "$speak = (talk)\n"
+        self.assertEqual({speak}, self.generator.reload_semantics_rules([semantics]))
+        self.assertIsNot(speak_pairs, self.generator.expand_semantics(speak))
+
+        # Editing only a wildcard's metadata is a change too, even though wildcards don't compare it
+        note = NonTerminal("note")
+        plain = Generator(None)
+        plain.rules = self.generator.rules
+        grammar.append("$note = go {void meta: old note} now\n")
+        self.assertEqual({note}, self.generator.reload_rules([grammar]))
+        self.assertEqual(["go {void meta: old note} now"], [tree_printer(sentence) for sentence in plain.generate(note)])
+        grammar[-1] = "$note = go {void meta: new note} now\n"
+        self.assertEqual({note}, self.generator.reload_rules([grammar]))
+        self.assertEqual(["go {void meta: new note} now"], [tree_printer(sentence) for sentence in plain.generate(note)])
+
+        # Same as loading the edited files from scratch
+        fresh = PairedGenerator(self.generator.knowledge_base, grammar_format_version=2018)
+        fresh.load_rules([grammar])
+        fresh.load_semantics_rules([semantics])
+        self.assertEqual(fresh.rules, self.generator.rules)
+        self.assertEqual(fresh.semantics, self.generator.semantics)
+        self.assertEqual(pairs_without_placeholders(fresh, use_cache=False),
+                         pairs_without_placeholders(self.generator, incremental=True, use_cache=False))
+
+    def test_reload_shared(self):
+        with open(os.path.join(FIXTURE_DIR, "grammar.txt")) as grammar_file:
+            grammar = grammar_file.readlines()
+        plain = load_2018(GRAMMAR_DIR_2018)
+        plain.rules = {}
+        plain.load_rules([grammar])
+        paired = PairedGenerator.from_generator(plain)
+        start = (Tree("expression", [NonTerminal("Main")]), Tree("expression", ["UNKNOWN"]))
+        self.assertEqual(6, len(list(paired.generate(start, yield_requires_semantics=False))))
+
+        # Reloading through one generator is seen by the other
+        grammar[3] = "$when = (now | later | soon)\n"
+        plain.reload_rules([grammar])
+        self.assertIs(plain.rules, paired.rules)
+        self.assertEqual(8, len(list(plain.generate(NonTerminal("Main")))))
+        self.assertEqual(8, len(list(paired.generate(start, yield_requires_semantics=False))))
+
+    def test_pairs_cache(self):
+        meta_remover = DiscardMeta()
+        generator = load_paired_2018(GRAMMAR_DIR_2018)
+        expected = pairs_without_placeholders(generator, use_cache=False)
+        previous = os.environ.get("GPSR_CACHE_DIR")
+        with tempfile.TemporaryDirectory() as temp_dir:
+            os.environ["GPSR_CACHE_DIR"] = temp_dir
+            try:
+                self.assertEqual(list(expected.items()), list(pairs_without_placeholders(generator).items()))
+                self.assertEqual(1, len(os.listdir(temp_dir)))
+                self.assertEqual(list(expected.items()), list(pairs_without_placeholders(generator).items()))
+                self.assertEqual(1, len(os.listdir(temp_dir)))
+                # Pairs whose utterances the grammar can't produce are left out
+                in_grammar = pairs_without_placeholders(generator, only_in_grammar=True)
+                self.assertEqual(1465, len(in_grammar))
+                self.assertEqual(in_grammar, pairs_without_placeholders(generator, only_in_grammar=True, use_cache=False))
+                # The grammar's sentences are on disk too, so another process doesn't enumerate them again
+                self.assertEqual(3, len(os.listdir(temp_dir)))
+                fresh = load_paired_2018(GRAMMAR_DIR_2018, use_cache=False)
+                fresh.enumerate = None
+                sentences = _grammar_sentences(fresh, use_cache=True)
+                self.assertEqual(len(_grammar_sentences(generator, use_cache=False)), len(sentences))
+                self.assertTrue(all(meta_remover.visit(copy.deepcopy(utterance)) in sentences for utterance in in_grammar))
+
+                # Edited semantics don't come back stale
+                def speak_logical():
+                    pairs = pairs_without_placeholders(self.generator)
+                    return tree_printer(pairs[Tree("expression", "say hi to him right now please".split())])
+
+                speak = Tree("expression", [NonTerminal("speak")])
+                self.assertEqual("( speak )", speak_logical())
+                self.generator.semantics[speak] = self.generator.lambda_parser.parse("(talk)")
+                self.generator.semantics_changed([speak])
+                self.assertEqual("( talk )", speak_logical())
+                self.assertEqual(5, len(os.listdir(temp_dir)))
+            finally:
+                if previous is None:
+                    del os.environ["GPSR_CACHE_DIR"]
+                else:
+                    os.environ["GPSR_CACHE_DIR"] = previous
+
+    def test_lazy_shorthand_pairs(self):
+        expanded = load_paired_2018(GRAMMAR_DIR_2018)
+        lazy = load_paired_2018(GRAMMAR_DIR_2018, expand_shorthand=False)
+        self.assertEqual(list(pairs_without_placeholders(expanded, use_cache=False).items()),
+                         list(pairs_without_placeholders(lazy, use_cache=False).items()))
+
     def test_ground(self):
         def expr_builder(string):
             return Tree("expression", string.split(" "))
@@ -122,3 +257,38 @@ class TestPairedGenerator(unittest.TestCase):
                          [ComplexWildCard("location", wildcard_id=2), "and", ComplexWildCard("name", wildcard_id=2)])
         expected = expr_builder("l1 and n1")
         self.assertEqual((expected, Tree(None, [])), self.generator.ground((test_tree, Tree(None, []))))
+
+    def test_grounded_text(self):
+        generator = load_paired_2018(GRAMMAR_DIR_2018)
+        pairs = list(pairs_without_placeholders(generator).items())[:100]
+        for pair in pairs:
+            trees = [(tree_printer(utt), tree_printer(logical)) for utt, logical in generator.generate_groundings(pair, count=5)]
+            self.assertEqual(trees, list(generator.generate_grounded_text(pair, count=5)))
+
+        # Anything the assignment leaves out prints as a wildcard
+        logical = Tree("expression", [ComplexWildCard("name", wildcard_id=1), "and", ComplexWildCard("name", wildcard_id=2)])
+        template = PrintTemplate(logical, constants=True)
+        self.assertEqual("\" n1 \" and {name 2}", template.render({ComplexWildCard("name", wildcard_id=1): "n1"}))
+
+    def test_semantics_template(self):
+        a, b = NonTerminal("a"), NonTerminal("b")
+        logical = Tree("expression", [a, Tree("predicate", [b, a])])
+        template = SemanticsTemplate(logical).substitute(a, Tree("expression", ["x", b, a])).substitute(b, "y")
+        # Later substitutions apply inside earlier replacements, but a replacement isn't substituted into itself
+        self.assertEqual(Tree("expression", [Tree("expression", ["x", "y", a]), Tree("predicate", [
+            "y", Tree("expression", ["x", "y", a])])]), template.to_tree())
+        self.assertEqual(Tree("expression", [a, Tree("predicate", [b, a])]), logical)
+
+    def test_bounded_frontier(self):
+        generator = load_paired_2018(GRAMMAR_DIR_2018)
+        pairs = {}
+        peaks = {}
+        for max_frontier in (None, 20, 0):
+            stats = {}
+            pairs[max_frontier] = set((tree_printer(utt), tree_printer(logical)) for utt, logical in
+                                      generator.generate(ROOT_SYMBOL, branch_cap=3, max_frontier=max_frontier, stats=stats))
+            peaks[max_frontier] = stats["peak_frontier"]
+        self.assertEqual(pairs[None], pairs[20])
+        self.assertEqual(pairs[None], pairs[0])
+        self.assertLess(peaks[0], peaks[20])
+        self.assertLess(peaks[20], peaks[None])